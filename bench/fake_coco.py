@@ -0,0 +1,157 @@
+import json
+import random
+import threading
+import time
+import uuid as uuidlib
+from nhc.hobby_api import (TOPIC_DEVICES_CMD, TOPIC_DEVICES_RSP, TOPIC_DEVICES_EVT, TOPIC_LOCATIONS_CMD,
+                           TOPIC_LOCATIONS_RSP, TOPIC_SYSTEM_CMD, TOPIC_SYSTEM_RSP)
+
+
+MODEL_PROPERTIES = {
+    "light": [{"Status": "Off"}],
+    "socket": [{"Status": "Off"}],
+    "switched-fan": [{"Status": "Off"}],
+    "switched-generic": [{"Status": "Off"}],
+    "dimmer": [{"Status": "Off"}, {"Brightness": "0"}],
+    "rolldownshutter": [{"Action": "Stop"}, {"Moving": "False"}, {"Position": "0"}],
+    "sunblind": [{"Action": "Stop"}, {"Moving": "False"}, {"Position": "0"}],
+    "gate": [{"Action": "Stop"}, {"Moving": "False"}, {"Position": "0"}],
+    "venetianblind": [{"Action": "Stop"}, {"Moving": "False"}, {"Position": "0"}],
+    "comfort": [{"BasicState": "Off"}],
+    "alloff": [{"BasicState": "Off"}],
+    "generic": [{"BasicState": "Off"}],
+}
+
+# storms step the brightness of dimmers, every event carries a value that identifies it in the HA state
+STORM_MODELS = ["dimmer"]
+
+
+def synthetic_devices(count, locations=8, seed=1):
+    # count action devices spread over all supported models, plus the gateway devices
+    rng = random.Random(seed)
+    models = sorted(MODEL_PROPERTIES)
+    devices = [
+        {"Uuid": str(uuidlib.UUID(int=rng.getrandbits(128))), "Name": "Home", "Model": "nhc", "Type": "home_automation",
+         "Online": "True", "Traits": [], "Parameters": [], "Properties": []},
+        {"Uuid": str(uuidlib.UUID(int=rng.getrandbits(128))), "Name": "gatewayfw", "Model": "gatewayfw", "Type": "gateway",
+         "Online": "True", "Traits": [{"HubType": "coco"}], "Parameters": [], "Properties": [{"CurrentFWInfo": "bench"}]},
+    ]
+    for index in range(count):
+        model = models[index % len(models)]
+        device = {}
+        device["Uuid"] = str(uuidlib.UUID(int=rng.getrandbits(128)))
+        device["Name"] = "%s %d" % (model, index)
+        device["Model"] = model
+        device["Type"] = "action"
+        device["Online"] = "True"
+        device["Traits"] = [{"MacAddress": "%08x" % index}, {"Channel": str(index % 4 + 1)}]
+        device["Parameters"] = [{"LocationName": "Room %d" % (index % locations)}, {"LocationIcon": "general"}]
+        device["Properties"] = [dict(_property) for _property in MODEL_PROPERTIES[model]]
+        devices.append(device)
+    return devices
+
+
+class fakeCOCO(object):
+    # answers the hobby API requests of one bridge and generates device events
+    def __init__(self, logger, devices):
+        self.logger = logger
+        self.devices = devices
+        self.client = None
+        self.controls = []
+        self.on_control = None
+        self._brightness = {}
+        self._lock = threading.Lock()
+        self._topic_handlers = {
+            TOPIC_DEVICES_CMD: self._devices_cmd,
+            TOPIC_LOCATIONS_CMD: self._locations_cmd,
+            TOPIC_SYSTEM_CMD: self._system_cmd,
+        }
+
+    def start(self, client, host, port):
+        self.client = client
+        self.client.on_connect = self._connect
+        self.client.on_message = self._message
+        self.client.connect(host, port)
+        self.client.loop_start()
+
+    def stop(self):
+        if self.client is None:
+            return
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _connect(self, client, obj, flags, rc):
+        self.client.subscribe([(topic, 0) for topic in self._topic_handlers])
+
+    def _message(self, client, obj, msg):
+        handler = self._topic_handlers.get(msg.topic)
+        if handler is not None:
+            handler(json.loads(msg.payload))
+
+    def _respond(self, topic, method, params):
+        self.client.publish(topic, json.dumps({"Method": method, "Params": params}))
+
+    def _devices_cmd(self, frame):
+        method = frame["Method"]
+        if method == "devices.list":
+            self._respond(TOPIC_DEVICES_RSP, method, [{"Devices": self.devices}])
+        elif method == "devices.control":
+            received = time.monotonic()
+            devices = frame["Params"][0]["Devices"]
+            with self._lock:
+                self.controls.append((received, devices))
+            if self.on_control is not None:
+                self.on_control(received, devices)
+            # the gateway confirms a control with a status event
+            self.client.publish(TOPIC_DEVICES_EVT, json.dumps(
+                {"Method": "devices.status", "Params": [{"Devices": devices}]}))
+
+    def _locations_cmd(self, frame):
+        names = sorted(set(self._location(device) for device in self.devices if device["Parameters"]))
+        locations = [{"Name": name, "Uuid": str(uuidlib.uuid5(uuidlib.NAMESPACE_OID, name)), "Icon": "general", "Index": str(index)}
+                     for index, name in enumerate(names)]
+        self._respond(TOPIC_LOCATIONS_RSP, frame["Method"], [{"Locations": locations}])
+
+    def _system_cmd(self, frame):
+        info = {"SWversion": "bench", "LastConfig": "", "WaterTariff": "0", "ElectricityTariff": "0", "GasTariff": "0",
+                "Currency": "EUR", "Units": "metric", "Language": "EN"}
+        self._respond(TOPIC_SYSTEM_RSP, frame["Method"], [{"SystemInfo": [info]}])
+
+    def _location(self, device):
+        return device["Parameters"][0]["LocationName"]
+
+    def storm_devices(self):
+        return [device["Uuid"] for device in self.devices if device["Model"] in STORM_MODELS]
+
+    def step(self, uuid):
+        # next brightness 1..100 for a device, always different from the previous event
+        with self._lock:
+            brightness = self._brightness.get(uuid, 0) % 100 + 1
+            self._brightness[uuid] = brightness
+        return brightness
+
+    def status_frame(self, uuids):
+        # returns the frame and the brightness sent per device
+        values = [(uuid, self.step(uuid)) for uuid in uuids]
+        devices = [{"Uuid": uuid, "Properties": [{"Status": "On"}, {"Brightness": str(value)}]} for uuid, value in values]
+        return {"Method": "devices.status", "Params": [{"Devices": devices}]}, values
+
+    def storm(self, events, rate=0, batch=1, on_sent=None):
+        # publish events status changes, batch devices per frame, rate frames per second (0: unpaced)
+        uuids = self.storm_devices()
+        interval = 0 if not rate else 1.0 / rate
+        sent = 0
+        index = 0
+        while sent < events:
+            chunk = []
+            while len(chunk) < min(batch, events - sent):
+                chunk.append(uuids[index % len(uuids)])
+                index += 1
+            frame, values = self.status_frame(chunk)
+            if on_sent is not None:
+                on_sent(time.monotonic(), values)
+            self.client.publish(TOPIC_DEVICES_EVT, json.dumps(frame))
+            sent += len(chunk)
+            if interval:
+                time.sleep(interval)
+        return sent
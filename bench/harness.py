@@ -0,0 +1,299 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+import paho.mqtt.client as mqtt
+import yaml
+from nhc.hobby_api import hobbyAPI, TOPIC_DEVICES_EVT
+from hass.mqtt import Hass
+from lib.startup import startupPipeline, STAGE_NHC_CONNECTED, STAGE_HASS_CONNECTED, STAGE_REGISTRY_LOADED, STAGE_DISCOVERY_COMPLETE
+from lib.workqueue import workQueue
+from bench.fake_coco import fakeCOCO, synthetic_devices
+from bench.loopback import loopbackBroker, loopbackMessage
+
+
+def write_config(config):
+    # temporary bridge configuration, the caller removes it
+    fd, path = tempfile.mkstemp(prefix="nhc-bench-", suffix=".yaml")
+    with os.fdopen(fd, "w") as fp:
+        yaml.dump(config, fp)
+    return path
+
+
+def summarize(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[int(p * (len(ordered) - 1))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+class benchHarness(object):
+    # a complete bridge wired to a simulated COCO, either in-process or on a local broker
+    def __init__(self, logger, devices=500, broker=None, config=None, timeout=60):
+        self.logger = logger
+        self.device_count = devices
+        self.broker = broker
+        self.config = config or {}
+        self.timeout = timeout
+        self.loopback = None
+        self.coco = None
+        self.hobby = None
+        self.hass = None
+        self.workqueue = None
+        self.observer = None
+        self._configfile = None
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._latencies = []
+        self._coalesced = 0
+        self._available = 0
+        self._changed = threading.Condition(self._lock)
+
+    def _address(self):
+        if self.broker is None:
+            return "127.0.0.1", 1883
+        host, _, port = self.broker.partition(":")
+        return host, int(port or 1883)
+
+    def _client(self):
+        if self.loopback is not None:
+            return self.loopback.client()
+        return mqtt.Client()
+
+    def _write_config(self):
+        host, port = self._address()
+        # discovery is timed by the per device availability topics, the last message of each device
+        config = {"username": "bench", "password": "bench", "nhc_host": host, "nhc_port": port, "nhc_tls": False,
+                  "hass_device_availability": True}
+        config.update(self.config)
+        self._configfile = write_config(config)
+
+    def setup(self):
+        host, port = self._address()
+        if self.broker is None:
+            self.loopback = loopbackBroker(self.logger)
+        self._write_config()
+        self.coco = fakeCOCO(self.logger, synthetic_devices(self.device_count))
+        self.coco.start(self._client(), host, port)
+        pipeline = startupPipeline(self.logger)
+        self.hobby = hobbyAPI(self.logger, self._configfile, pipeline=pipeline)
+        self.hass = Hass(self.logger, hobby=self.hobby, host=host, port=port, pipeline=pipeline)
+        # same wiring as the bridge application
+        self.workqueue = workQueue(self.logger, self.hobby.runtime,
+                                   maxsize=self.hobby.get_config("hass_queue_size", 1000),
+                                   policy=self.hobby.get_config("hass_queue_policy", "block"),
+                                   workers=self.hobby.get_config("hass_queue_workers", 1),
+                                   report_interval=0)
+        self.workqueue.start()
+        self.hass.workqueue = self.workqueue
+        self.hobby.set_callbacks(self.workqueue.handoff(self.hass.nhc_status_update, merge=True),
+                                 self.workqueue.handoff(self.hass.nhc_remove_device),
+                                 self.workqueue.handoff(self.hass.nhc_add_device))
+        started = time.monotonic()
+        self.hobby.start(client=self._client() if self.loopback is not None else None)
+        self.hass.start(client=self._client())
+        stages = [STAGE_NHC_CONNECTED, STAGE_HASS_CONNECTED, STAGE_REGISTRY_LOADED, STAGE_DISCOVERY_COMPLETE]
+        if not pipeline.wait(stages, timeout=self.timeout):
+            raise RuntimeError("bridge not ready within %ds" % self.timeout)
+        self.startup = dict((stage, round(pipeline.timings[stage], 3)) for stage in stages)
+        self.startup["total"] = round(time.monotonic() - started, 3)
+        self._start_observer(host, port)
+
+    def _start_observer(self, host, port):
+        # plays Home Assistant: sees the published states and sends set commands
+        connected = threading.Event()
+        subscribed = threading.Event()
+        self.observer = self._client()
+        self.observer.on_connect = lambda client, obj, flags, rc: connected.set()
+        self.observer.on_subscribe = lambda client, obj, mid, qos: subscribed.set()
+        self.observer.on_message = self._observe
+        self.observer.connect(host, port)
+        self.observer.loop_start()
+        connected.wait(self.timeout)
+        self.observer.subscribe([("homeassistant/+/+/state", 0), ("homeassistant/+/+/available", 0)])
+        subscribed.wait(self.timeout)
+
+    def teardown(self):
+        if self.observer is not None:
+            self.observer.disconnect()
+            self.observer.loop_stop()
+        if self.hass is not None and self.hass.publisher is not None:
+            self.hass.stop()
+        if self.hobby is not None:
+            self.hobby.stop()
+        if self.workqueue is not None:
+            self.workqueue.stop()
+        if self.coco is not None:
+            self.coco.stop()
+        if self.hobby is not None:
+            self.hobby.runtime.stop()
+        if self.loopback is not None:
+            self.loopback.stop()
+        if self._configfile is not None:
+            os.remove(self._configfile)
+
+    def _observe(self, client, obj, msg):
+        if msg.retain:
+            return
+        received = time.monotonic()
+        uuid = msg.topic.split("/")[2]
+        with self._lock:
+            if msg.topic.endswith("/available"):
+                self._available += 1
+            elif uuid in self._waiting:
+                try:
+                    self._match(uuid, json.loads(msg.payload).get("brightness"), received)
+                except ValueError:
+                    pass
+            self._changed.notify_all()
+
+    def _match(self, uuid, brightness, received):
+        # the state carries the newest brightness, older events of the device were coalesced into it
+        sent = self._waiting.get(uuid)
+        if not sent or not any(value == brightness for _, value in sent):
+            return
+        while sent:
+            started, value = sent.popleft()
+            if value == brightness:
+                self._latencies.append(received - started)
+                return
+            self._coalesced += 1
+
+    def _wait(self, predicate):
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def event_throughput(self, events=10000, batch=1):
+        # raw cost of _message_devices_event, Hass handoff replaced by a counter
+        callbacks = []
+        saved = (self.hobby.device_update_callback, self.hobby.device_remove_callback, self.hobby.device_add_callback)
+        self.hobby.set_callbacks(lambda device, changes: callbacks.append(device), saved[1], saved[2])
+        uuids = self.coco.storm_devices()
+        frames = []
+        index = 0
+        while index < events:
+            chunk = [uuids[(index + offset) % len(uuids)] for offset in range(min(batch, events - index))]
+            frames.append(loopbackMessage(TOPIC_DEVICES_EVT, json.dumps(self.coco.status_frame(chunk)[0])))
+            index += len(chunk)
+        try:
+            started = time.perf_counter()
+            for msg in frames:
+                self.hobby._message_devices_event(None, msg)
+            elapsed = time.perf_counter() - started
+        finally:
+            self.hobby.set_callbacks(*saved)
+        return {
+            "events": events,
+            "frames": len(frames),
+            "batch": batch,
+            "seconds": round(elapsed, 6),
+            "events_per_second": round(events / elapsed, 1),
+            "frames_per_second": round(len(frames) / elapsed, 1),
+            "callbacks": len(callbacks),
+        }
+
+    def discovery(self, cold=True):
+        # Hass.discover_all until every device published its availability and the publisher drained;
+        # a cold run forgets the fingerprints so every config is sent again
+        if cold:
+            self.hass.publisher.fingerprints.reset()
+        expected = len([uuid for uuid in self.hobby.list_uuid_action()
+                        if self.hass.nhc_to_hass_model(self.hobby.get_device(uuid)["Model"]) is not None])
+        with self._lock:
+            self._available = 0
+        skipped = self.hass.publisher.fingerprints.skipped
+        started = time.monotonic()
+        self.hass.discover_all()
+        done = self._wait(lambda: self._available >= expected)
+        while done and (self.workqueue.depth() or self.hass.publisher.pending()):
+            time.sleep(0.001)
+        elapsed = time.monotonic() - started
+        return {
+            "cold": cold,
+            "devices": expected,
+            "complete": done,
+            "seconds": round(elapsed, 3),
+            "devices_per_second": round(expected / elapsed, 1),
+            "configs_skipped": self.hass.publisher.fingerprints.skipped - skipped,
+        }
+
+    def end_to_end(self, events=2000, rate=0, batch=1):
+        # devices.status published by the COCO until the state arrives at Home Assistant
+        with self._lock:
+            self._waiting = {}
+            self._latencies = []
+            self._coalesced = 0
+
+        def sent(timestamp, values):
+            with self._lock:
+                for uuid, brightness in values:
+                    # the light entity reports brightness on a 0..255 scale
+                    self._waiting.setdefault(uuid, deque()).append((timestamp, int(brightness * 2.55)))
+
+        started = time.monotonic()
+        self.coco.storm(events, rate, batch, on_sent=sent)
+        publish_done = time.monotonic() - started
+        complete = self._wait(lambda: len(self._latencies) + self._coalesced >= events)
+        elapsed = time.monotonic() - started
+        resolved = len(self._latencies) + self._coalesced
+        result = {"events": events, "rate": rate, "batch": batch, "complete": complete,
+                  "publish_seconds": round(publish_done, 3), "seconds": round(elapsed, 3),
+                  "events_per_second": round(resolved / elapsed, 1),
+                  "published": len(self._latencies), "coalesced": self._coalesced, "lost": events - resolved}
+        result["latency"] = summarize(self._latencies)
+        return result
+
+    def set_to_nhc(self, commands=200, interval=0.01):
+        # Home Assistant set command until the devices.control frame reaches the COCO
+        lights = [device["Uuid"] for device in self.coco.devices if device["Model"] in ["light", "dimmer"]]
+        sent = {}
+        latencies = []
+        received = threading.Condition()
+
+        def control(timestamp, devices):
+            # commands merged by the debounce window all ride on this frame
+            with received:
+                for device in devices:
+                    for started in sent.pop(device["Uuid"], []):
+                        latencies.append(timestamp - started)
+                received.notify_all()
+
+        self.coco.on_control = control
+        try:
+            for index in range(commands):
+                uuid = lights[index % len(lights)]
+                state = "ON" if index // len(lights) % 2 == 0 else "OFF"
+                with received:
+                    sent.setdefault(uuid, []).append(time.monotonic())
+                self.observer.publish("homeassistant/light/%s/set" % uuid, json.dumps({"state": state}))
+                if interval:
+                    time.sleep(interval)
+            deadline = time.monotonic() + self.timeout
+            with received:
+                while sent and time.monotonic() < deadline:
+                    received.wait(deadline - time.monotonic())
+                lost = sum(len(pending) for pending in sent.values())
+        finally:
+            self.coco.on_control = None
+        return {"commands": commands, "debounce": self.hobby.commands.window, "lost": lost,
+                "latency": summarize(latencies)}
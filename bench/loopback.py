@@ -0,0 +1,162 @@
+import queue
+import threading
+import paho.mqtt.client as mqtt
+
+
+class loopbackInfo(object):
+    def __init__(self, mid, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+
+
+class loopbackMessage(object):
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, bytes):
+            payload = str(payload).encode("utf-8")
+        self.payload = payload
+        self.retain = retain
+        self.qos = 0
+
+
+class loopbackBroker(object):
+    # in-process stand-in for a broker: one dispatch thread routes publishes to subscribed clients
+    def __init__(self, logger):
+        self.logger = logger
+        self._clients = []
+        self._retained = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._dispatch, name="loopback-broker", daemon=True)
+        self._thread.start()
+
+    def client(self):
+        return loopbackClient(self)
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _attach(self, client):
+        with self._lock:
+            if client not in self._clients:
+                self._clients.append(client)
+        self._queue.put((client.on_connect, (client, None, {}, 0)))
+
+    def _detach(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+        if client.on_disconnect is not None:
+            self._queue.put((client.on_disconnect, (client, None, 0)))
+
+    def _subscribed(self, client, topic):
+        with self._lock:
+            retained = [(name, payload) for name, payload in self._retained.items() if mqtt.topic_matches_sub(topic, name)]
+        for name, payload in retained:
+            self._queue.put((self._deliver, (client, loopbackMessage(name, payload, retain=True))))
+
+    def _publish(self, sender, mid, topic, payload, retain):
+        self._queue.put((self._route, (sender, mid, topic, payload, retain)))
+
+    def _route(self, sender, mid, topic, payload, retain):
+        if retain:
+            with self._lock:
+                if payload:
+                    self._retained[topic] = payload
+                else:
+                    self._retained.pop(topic, None)
+        with self._lock:
+            clients = [client for client in self._clients if client.matches(topic)]
+        for client in clients:
+            self._deliver(client, loopbackMessage(topic, payload))
+        if sender.on_publish is not None:
+            sender.on_publish(sender, None, mid)
+
+    def _deliver(self, client, msg):
+        if client.on_message is not None:
+            client.on_message(client, None, msg)
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            callback, args = item
+            if callback is None:
+                continue
+            try:
+                callback(*args)
+            except Exception as exc:
+                self.logger.error("loopback dispatch failed: %s", exc)
+
+
+class loopbackClient(object):
+    # the subset of the paho client used by the bridge
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self._subscriptions = set()
+        self._mid = 0
+        self._lock = threading.Lock()
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+    def connect(self, host=None, port=None, *args, **kwargs):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def connect_async(self, host=None, port=None, *args, **kwargs):
+        pass
+
+    def loop_start(self):
+        # the connection is up once the client starts its loop, like connect_async
+        self.broker._attach(self)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        self.broker._detach(self)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def matches(self, topic):
+        return any(mqtt.topic_matches_sub(sub, topic) for sub in list(self._subscriptions))
+
+    def subscribe(self, topic, qos=0):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for name, _ in topics:
+            self._subscriptions.add(name)
+            self.broker._subscribed(self, name)
+        mid = self._next_mid()
+        self.broker._queue.put((self.on_subscribe, (self, None, mid, [qos for _, qos in topics])))
+        return (mqtt.MQTT_ERR_SUCCESS, mid)
+
+    def unsubscribe(self, topic):
+        topics = topic if isinstance(topic, list) else [topic]
+        for name in topics:
+            self._subscriptions.discard(name)
+        return (mqtt.MQTT_ERR_SUCCESS, self._next_mid())
+
+    def _next_mid(self):
+        with self._lock:
+            self._mid += 1
+            return self._mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = self._next_mid()
+        self.broker._publish(self, mid, topic, payload, retain)
+        return loopbackInfo(mid)
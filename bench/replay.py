@@ -0,0 +1,125 @@
+import os
+import time
+from nhc.hobby_api import hobbyAPI
+from hass.mqtt import Hass
+from lib.recorder import read_recording, SOURCE_NHC, SOURCE_HASS, SOURCE_NAMES
+from lib.startup import startupPipeline, STAGE_NHC_CONNECTED, STAGE_HASS_CONNECTED
+from lib.workqueue import workQueue
+from bench.harness import write_config
+from bench.loopback import loopbackBroker, loopbackMessage
+
+
+# settings that would touch the real installation are never taken from the bridge config
+REPLAY_CONFIG = {
+    "nhc_host": "127.0.0.1",
+    "nhc_tls": False,
+    "nhc_gateway_cache": None,
+    "nhc_gateway_watch": 0,
+    "nhc_snapshot_file": None,
+    "hass_fingerprint_file": None,
+    "hass_seed_fingerprints": False,
+    "metrics_port": None,
+    "record_file": None,
+}
+
+
+class replayRunner(object):
+    # feeds a recording through hobbyAPI._message and Hass.message, the brokers are a loopback stand-in
+    def __init__(self, logger, path, config=None, speed=1.0, timeout=60):
+        self.logger = logger
+        self.path = path
+        self.config = dict(config or {})
+        self.config.setdefault("username", "replay")
+        self.config.setdefault("password", "replay")
+        self.config.update(REPLAY_CONFIG)
+        self.speed = speed
+        self.timeout = timeout
+        self.loopback = None
+        self.hobby = None
+        self.hass = None
+        self.workqueue = None
+        self._configfile = None
+
+    def setup(self):
+        self.loopback = loopbackBroker(self.logger)
+        self._configfile = write_config(self.config)
+        pipeline = startupPipeline(self.logger)
+        self.hobby = hobbyAPI(self.logger, self._configfile, pipeline=pipeline)
+        self.hass = Hass(self.logger, hobby=self.hobby, host="127.0.0.1", pipeline=pipeline)
+        self.workqueue = workQueue(self.logger, self.hobby.runtime,
+                                   maxsize=self.hobby.get_config("hass_queue_size", 1000),
+                                   policy=self.hobby.get_config("hass_queue_policy", "block"),
+                                   workers=self.hobby.get_config("hass_queue_workers", 1),
+                                   report_interval=0)
+        self.workqueue.start()
+        self.hass.workqueue = self.workqueue
+        self.hobby.set_callbacks(self.workqueue.handoff(self.hass.nhc_status_update, merge=True),
+                                 self.workqueue.handoff(self.hass.nhc_remove_device),
+                                 self.workqueue.handoff(self.hass.nhc_add_device))
+        self.hobby.start(client=self.loopback.client())
+        self.hass.start(client=self.loopback.client())
+        if not pipeline.wait([STAGE_NHC_CONNECTED, STAGE_HASS_CONNECTED], timeout=self.timeout):
+            raise RuntimeError("bridge not ready within %ds" % self.timeout)
+
+    def teardown(self):
+        if self.hass is not None and self.hass.publisher is not None:
+            self.hass.stop()
+        if self.hobby is not None:
+            self.hobby.stop()
+        if self.workqueue is not None:
+            self.workqueue.stop()
+        if self.hobby is not None:
+            self.hobby.runtime.stop()
+        if self.loopback is not None:
+            self.loopback.stop()
+        if self._configfile is not None:
+            os.remove(self._configfile)
+
+    def run(self):
+        # speed 1 replays in real time, 2 twice as fast, 0 as fast as possible
+        handlers = {
+            SOURCE_NHC: (self.hobby._message, self.hobby.client),
+            SOURCE_HASS: (self.hass.message, self.hass.client),
+        }
+        counts = dict((name, 0) for name in SOURCE_NAMES.values())
+        first = None
+        recorded = 0
+        started = time.monotonic()
+        for timestamp, source, topic, payload in read_recording(self.path):
+            if first is None:
+                first = timestamp
+            recorded = timestamp - first
+            if self.speed:
+                delay = recorded / self.speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            handler, client = handlers[source]
+            handler(client, None, loopbackMessage(topic, payload))
+            counts[SOURCE_NAMES[source]] += 1
+        fed = time.monotonic() - started
+        drained = self._drain()
+        elapsed = time.monotonic() - started
+        messages = sum(counts.values())
+        metrics = self.hobby.metrics
+        return {
+            "recording": self.path,
+            "speed": self.speed,
+            "messages": counts,
+            "recorded_seconds": round(recorded, 3),
+            "feed_seconds": round(fed, 3),
+            "seconds": round(elapsed, 3),
+            "drained": drained,
+            "messages_per_second": round(messages / elapsed, 1) if elapsed else None,
+            "hass_publishes": metrics.total("hass_publishes_total"),
+            "hass_suppressed": metrics.total("hass_suppressed_total"),
+            "queue_high_water": self.workqueue.high_water,
+            "queue_dropped": self.workqueue.dropped,
+        }
+
+    def _drain(self):
+        deadline = time.monotonic() + self.timeout
+        while self.workqueue.depth() or self.hass.publisher.pending() or self.hobby.commands.pending():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
@@ -1,43 +1,39 @@
 import json
-import time
 
 class HassBinarySensor(object):
+    component = "binary_sensor"
+    watch = frozenset(["Status"])
+    restate = False # a replayed motion would trigger automations
+
     def __init__(self, logger, hass, hobby):
         self.logger = logger
         self.hass = hass
         self.hobby = hobby
 
-    def discover(self, device, payload):
-        uuid = device["Uuid"]
-        main_topic = "homeassistant/binary_sensor/" + uuid
-        config_topic = main_topic + "/config"
-        payload["~"] = main_topic
+    def prepare(self, entity, device):
+        pass
+
+    def discover(self, entity, device, payload):
+        payload["~"] = entity.base_topic
         payload["off_delay"] = 10
         del(payload["command_topic"]) # a binary_sensor doesn't have a command topic
-        self.hass.publish(config_topic, json.dumps(payload))
-        time.sleep(0.1)
-        self.availability(uuid)
+        self.hass.enqueue_config(entity.config_topic, json.dumps(payload))
 
-    def update(self, device):
-        uuid = device["Uuid"]
+    def state(self, entity, device, changes=None):
         properties = device["Properties"]
-        status = None
-        i = 0
-        while i < len(properties):
-            _property = list(properties[i].keys())[0]
-            _value = list(properties[i].values())[0]
-            if _property == "Status":
-                status = _value.upper()
-                break
-            i += 1
+        status = properties.get("Status")
         if status is None:
-            return
-        topic = "homeassistant/binary_sensor/" + uuid + "/state"
-        self.hass.publish(topic, status)
+            return None
+        return status.upper()
+
+    def update(self, entity, device, changes=None):
+        state = self.state(entity, device, changes)
+        if state is None:
+            return False
+        return self.hass.publish_state(entity.state_topic, state)
 
-    def set(self, uuid, payload):
+    def set(self, entity, payload):
         pass # a binary_sensor doesn't have a command topic
 
-    def availability(self, uuid, mode="online"):
-        topic = "homeassistant/binary_sensor/" + uuid + "/available"
-        self.hass.publish(topic, mode, retain=True)
+    def availability(self, entity, mode="online"):
+        self.hass.publish(entity.available_topic, mode, retain=True)
@@ -1,53 +1,41 @@
 import json
-import time
+
+COVER_DEVICE_CLASSES = {
+    "sunblind": "awning",
+    "gate": "gate",
+    "venetianblind": "blind",
+}
 
 class HassCover(object):
+    component = "cover"
+    watch = frozenset(["Action", "Moving", "Position"])
+    restate = True
+
     def __init__(self, logger, hass, hobby):
         self.logger = logger
         self.hass = hass
         self.hobby = hobby
 
-    def discover(self, device, payload):
-        uuid = device["Uuid"]
-        if device["Model"] == "sunblind":
-            _device_class = "awning"
-        elif device["Model"] == "gate":
-            _device_class = "gate"
-        elif device["Model"] == "venetianblind":
-            _device_class = "blind"
-        else:
-            _device_class = "shutter"
-        main_topic = "homeassistant/cover/" + uuid
-        config_topic = main_topic + "/config"
-        payload["~"] = main_topic
-        payload["device_class"] = _device_class
+    def prepare(self, entity, device):
+        pass
+
+    def discover(self, entity, device, payload):
+        payload["~"] = entity.base_topic
+        payload["device_class"] = COVER_DEVICE_CLASSES.get(device["Model"], "shutter")
         payload["state_open"] = "OPEN"
         payload["state_opening"] = "OPENING"
         payload["state_closed"] = "CLOSE"
         payload["state_closing"] = "CLOSING"
-        self.hass.publish(config_topic, json.dumps(payload))
-        time.sleep(0.1)
-        self.update(device)
-        time.sleep(0.1)
-        self.availability(uuid)
+        self.hass.enqueue_config(entity.config_topic, json.dumps(payload))
+        state = self.state(entity, device)
+        if state is not None:
+            self.hass.enqueue_state(entity.state_topic, state)
 
-    def update(self, device):
-        uuid = device["Uuid"]
+    def state(self, entity, device, changes=None):
         properties = device["Properties"]
-        state = ""
-        moving = ""
-        position = ""
-        i = 0
-        while i < len(properties):
-            _property = list(properties[i].keys())[0]
-            _value = list(properties[i].values())[0]
-            if _property == "Action":
-                state = _value.upper()
-            elif _property == "Moving":
-                moving = _value.upper()
-            elif _property == "Position":
-                position = _value.upper()
-            i += 1
+        state = properties.get("Action", "").upper()
+        moving = properties.get("Moving", "").upper()
+        position = properties.get("Position", "").upper()
         if moving == "TRUE":
             if state == "OPEN" or position == "100":
                 state = "CLOSING"
@@ -60,14 +48,18 @@ class HassCover(object):
                 state = "OPEN"
 
         if state == "":
-            return
-        topic = "homeassistant/cover/" + uuid + "/state"
-        self.hass.publish(topic, state)
+            return None
+        return state
+
+    def update(self, entity, device, changes=None):
+        state = self.state(entity, device, changes)
+        if state is None:
+            return False
+        return self.hass.publish_state(entity.state_topic, state)
 
-    def set(self, uuid, payload):
+    def set(self, entity, payload):
         state = payload.decode('ascii').capitalize()
-        self.hobby.devices_control(uuid, "Action", state)
+        entity.gateway.commands.submit(entity.uuid, {"Action": state})
 
-    def availability(self, uuid, mode="online"):
-        topic = "homeassistant/cover/" + uuid + "/available"
-        self.hass.publish(topic, mode, retain=True)
+    def availability(self, entity, mode="online"):
+        self.hass.publish(entity.available_topic, mode, retain=True)
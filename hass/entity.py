@@ -0,0 +1,25 @@
+class HassEntity(object):
+    # one per discovered device: topics and templates are built once, not on every event
+    __slots__ = ("uuid", "object_id", "gateway", "hass_model", "handler", "base_topic", "config_topic", "state_topic",
+                 "available_topic", "set_topic", "state_template")
+
+    def __init__(self, uuid, hass_model, handler, device=None, gateway=None):
+        self.uuid = uuid
+        self.gateway = gateway
+        self.object_id = uuid if gateway is None else gateway.object_id(uuid)
+        self.hass_model = hass_model
+        self.handler = handler
+        self.base_topic = "homeassistant/" + handler.component + "/" + self.object_id
+        self.config_topic = self.base_topic + "/config"
+        self.state_topic = self.base_topic + "/state"
+        self.available_topic = self.base_topic + "/available"
+        self.set_topic = self.base_topic + "/set"
+        self.state_template = None
+        if device is not None:
+            handler.prepare(self, device)
+
+    def update(self, device, changes):
+        # True when a state publish was sent or queued for coalescing
+        if changes is not None and self.handler.watch.isdisjoint(changes):
+            return False
+        return self.handler.update(self, device, changes)
@@ -1,44 +1,41 @@
 import json
-import time
 
 class HassFan(object):
+    component = "fan"
+    watch = frozenset(["Status"])
+    restate = True
+
     def __init__(self, logger, hass, hobby):
         self.logger = logger
         self.hass = hass
         self.hobby = hobby
 
-    def discover(self, device, payload):
-        uuid = device["Uuid"]
-        main_topic = "homeassistant/fan/" + uuid
-        config_topic = main_topic + "/config"
-        payload["~"] = main_topic
-        self.hass.publish(config_topic, json.dumps(payload))
-        time.sleep(0.1)
-        self.update(device)
-        time.sleep(0.1)
-        self.availability(uuid)
-
-    def update(self, device):
-        uuid = device["Uuid"]
+    def prepare(self, entity, device):
+        pass
+
+    def discover(self, entity, device, payload):
+        payload["~"] = entity.base_topic
+        self.hass.enqueue_config(entity.config_topic, json.dumps(payload))
+        state = self.state(entity, device)
+        if state is not None:
+            self.hass.enqueue_state(entity.state_topic, state)
+
+    def state(self, entity, device, changes=None):
         properties = device["Properties"]
-        status = None
-        i = 0
-        while i < len(properties):
-            _property = list(properties[i].keys())[0]
-            _value = list(properties[i].values())[0]
-            if _property == "Status":
-                status = _value.upper()
-                break
-            i += 1
+        status = properties.get("Status")
         if status is None:
-            return
-        topic = "homeassistant/fan/" + uuid + "/state"
-        self.hass.publish(topic, status)
+            return None
+        return status.upper()
+
+    def update(self, entity, device, changes=None):
+        state = self.state(entity, device, changes)
+        if state is None:
+            return False
+        return self.hass.publish_state(entity.state_topic, state)
 
-    def set(self, uuid, payload):
+    def set(self, entity, payload):
         state = payload.decode('ascii').capitalize()
-        self.hobby.devices_control(uuid, "Status", state)
+        entity.gateway.commands.submit(entity.uuid, {"Status": state})
 
-    def availability(self, uuid, mode="online"):
-        topic = "homeassistant/fan/" + uuid + "/available"
-        self.hass.publish(topic, mode, retain=True)
+    def availability(self, entity, mode="online"):
+        self.hass.publish(entity.available_topic, mode, retain=True)
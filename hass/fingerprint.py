@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+
+class HassFingerprints(object):
+    def __init__(self, logger, runtime, path=None, delay=5):
+        self.logger = logger
+        self.runtime = runtime
+        self.path = path
+        self.delay = delay
+        self.skipped = 0
+        # fingerprints from an earlier run, the broker may have lost its retained configs since
+        self.loaded = False
+        self._fingerprints = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def _digest(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        return hashlib.sha1(payload).hexdigest()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, mode='r') as fp:
+                self._fingerprints = json.load(fp)
+        except (OSError, ValueError) as exc:
+            self.logger.warning("fingerprints %s not readable: %s", self.path, exc)
+            return
+        self.loaded = True
+        self.logger.info("loaded %d discovery fingerprints", len(self._fingerprints))
+
+    def changed(self, topic, payload):
+        # True when the config must be (re)published, it is recorded once the broker has it
+        digest = self._digest(payload)
+        with self._lock:
+            if self._fingerprints.get(topic) == digest:
+                self.skipped += 1
+                return False
+        return True
+
+    def record(self, topic, payload):
+        with self._lock:
+            self._fingerprints[topic] = self._digest(payload)
+        self._mark_dirty()
+
+    def seed(self, topic, payload):
+        # fingerprint of a retained config as the broker holds it
+        with self._lock:
+            if not payload:
+                self._fingerprints.pop(topic, None)
+            else:
+                self._fingerprints[topic] = self._digest(payload)
+
+    def forget(self, topic):
+        with self._lock:
+            if self._fingerprints.pop(topic, None) is None:
+                return
+        self._mark_dirty()
+
+    def reset(self):
+        with self._lock:
+            self._fingerprints = {}
+        self._mark_dirty()
+
+    def _mark_dirty(self):
+        if self.path is None:
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = self.runtime.call_later(self.delay, self.save)
+
+    def save(self):
+        with self._lock:
+            self._timer = None
+            frame = dict(self._fingerprints)
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".fingerprints-", dir=directory)
+        try:
+            with os.fdopen(fd, mode='w') as fp:
+                json.dump(frame, fp)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            self.logger.warning("fingerprints %s not written: %s", self.path, exc)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -1,62 +1,74 @@
 import json
-import time
+
+LIGHT_STATE = '{"state": "%s"}'
+LIGHT_STATE_BRIGHTNESS = '{"state": "%s", "brightness": %d}'
 
 class HassLight(object):
+    component = "light"
+    watch = frozenset(["Status", "Brightness"])
+    restate = True
+
     def __init__(self, logger, hass, hobby):
         self.logger = logger
         self.hass = hass
         self.hobby = hobby
 
-    def discover(self, device, payload):
-        uuid = device["Uuid"]
-        main_topic = "homeassistant/light/" + uuid
-        config_topic = main_topic + "/config"
-        payload["~"] = main_topic
+    def prepare(self, entity, device):
+        if "Brightness" in device["Properties"]:
+            entity.state_template = LIGHT_STATE_BRIGHTNESS
+        else:
+            entity.state_template = LIGHT_STATE
+
+    def discover(self, entity, device, payload):
+        payload["~"] = entity.base_topic
         payload["schema"] = "json"
         if device["Model"] == "dimmer":
             payload["brightness"] = True
         else:
             payload["brightness"] = False
-        self.hass.publish(config_topic, json.dumps(payload))
-        time.sleep(0.1)
-        self.update(device)
-        time.sleep(0.1)
-        self.availability(uuid)
-
-    def update(self, device):
-        uuid = device["Uuid"]
+        self.hass.enqueue_config(entity.config_topic, json.dumps(payload))
+        state = self.state(entity, device)
+        if state is not None:
+            self.hass.enqueue_state(entity.state_topic, state)
+
+    def state(self, entity, device, changes=None):
         properties = device["Properties"]
-        status = None
-        brightness = None
-        i = 0
-        while i < len(properties):
-            _property = list(properties[i].keys())[0]
-            _value = list(properties[i].values())[0]
-            if _property == "Status":
-                status = _value.upper()
-            elif _property == "Brightness":
-                brightness = int(_value)
-            i += 1
+        status = properties.get("Status")
+        brightness = properties.get("Brightness")
+        if status is None or (brightness is None) != (entity.state_template is LIGHT_STATE):
+            # the properties do not fit the template built at discovery
+            return self._state_frame(status, brightness)
+        if brightness is None:
+            return entity.state_template % status.upper()
+        return entity.state_template % (status.upper(), int(int(brightness) * 2.55))
+
+    def _state_frame(self, status, brightness):
         if status is None and brightness is None:
-            return
-        topic = "homeassistant/light/" + uuid + "/state"
+            return None
+        if status is not None:
+            status = status.upper()
         frame = {}
         frame["state"] = status
         if brightness is not None:
-            frame["brightness"] = int(brightness * 2.55)
+            frame["brightness"] = int(int(brightness) * 2.55)
+        return json.dumps(frame)
 
-        self.hass.publish(topic, json.dumps(frame))
+    def update(self, entity, device, changes=None):
+        state = self.state(entity, device, changes)
+        if state is None:
+            return False
+        return self.hass.publish_state(entity.state_topic, state)
 
-    def set(self, uuid, payload):
+    def set(self, entity, payload):
         frame = json.loads(payload)
         state = frame["state"].capitalize()
+        properties = {"Status": state}
         try:
             brightness = frame["brightness"]
-            brightness = int(brightness/2.55)
-            self.hobby.devices_control(uuid, "Status", state, "Brightness", str(brightness))
+            properties["Brightness"] = str(int(brightness/2.55))
         except:
-            self.hobby.devices_control(uuid, "Status", state)
+            pass
+        entity.gateway.commands.submit(entity.uuid, properties)
 
-    def availability(self, uuid, mode="online"):
-        topic = "homeassistant/light/" + uuid + "/available"
-        self.hass.publish(topic, mode, retain=True)
+    def availability(self, entity, mode="online"):
+        self.hass.publish(entity.available_topic, mode, retain=True)
@@ -1,19 +1,27 @@
 import paho.mqtt.client as mqtt
-import threading
-import json
-import logging
 import socket
-import time
 from nhc.hobby_api import NHC_MODELS
+from nhc.registry import nhc_to_hass_model, NHC_UNSUPPORTED_MODELS
 from hass.light import HassLight
 from hass.switch import HassSwitch, HassSwitchMood
 from hass.cover import HassCover
 from hass.fan import HassFan
 from hass.binary_sensor import HassBinarySensor
+from hass.entity import HassEntity
+from hass.publisher import HassPublisher
+from hass.fingerprint import HassFingerprints
+from lib.recorder import SOURCE_HASS
+from lib.startup import STAGE_HASS_CONNECTED, STAGE_REGISTRY_LOADED, STAGE_DISCOVERY_COMPLETE
+
+
+TOPIC_HASS_STATUS = "homeassistant/status"
+TOPIC_HASS_SET = "homeassistant/+/+/set"
+TOPIC_HASS_CONFIG = "homeassistant/+/+/config"
+TOPIC_BRIDGE_AVAILABILITY = "nhchabridge/availability"
 
 
 class Hass(object):
-    def __init__(self, logger, hobby=None, host=None, port=1883, connect_timeout=60):
+    def __init__(self, logger, hobby=None, host=None, port=1883, connect_timeout=60, pipeline=None):
         self.logger = logger
         self.host = host
         self.port = port
@@ -21,68 +29,246 @@ class Hass(object):
         self.hobby = hobby
         self.connected = False
         self.client = None
+        self.publisher = None
         self.hass_online = True # assume online because no method to poll
+        self._topic_handlers = {TOPIC_HASS_STATUS: self.hass_status}
+        # per device topics are dispatched on their last segment, counted under their wildcard subscription
+        self._segment_handlers = {"set": (TOPIC_HASS_SET, self.hass_set), "config": (TOPIC_HASS_CONFIG, self.hass_config)}
+        self._handlers = {}
+        self.entities = {}
+        self.seed_fingerprints = False
+        self.seed_fingerprints_time = 2
+        self.pipeline = pipeline
+        self.workqueue = None
+        self._registry_drained = False
+        self._removed_offline = {}
         if self.hobby is None:
             return
+        if self.pipeline is None:
+            self.pipeline = self.hobby.pipeline
+        self.runtime = self.hobby.runtime
+        self.qos = self.hobby.get_config("hass_qos", 1)
+        # one retained topic, also the last will, marks every entity unavailable when the bridge is gone
+        self.availability_topic = self.hobby.get_config("hass_availability_topic", TOPIC_BRIDGE_AVAILABILITY)
+        self.device_availability = self.hobby.get_config("hass_device_availability", False)
+        # opt in: one HA device per NHC location with its suggested_area; off, every entity stays on the gateway device
+        self.area_devices = self.hobby.get_config("hass_area_devices", False)
+        self.pipeline.on(STAGE_REGISTRY_LOADED, self._registry_loaded)
         if self.host is None:
             self.host = "homeassistant.local"
     
     def _connect_timeout_handler(self):
         if self.connected:
             return
-        self.logger.info("Cannot connect to hass broker")
-        self.connected = False
-        self.client.disconnect()
+        # the runtime keeps retrying with backoff, entities and state caches are kept
+        self.logger.warning("Cannot connect to hass broker within %ds, still trying", self.connect_timeout)
 
     def is_connected(self):
         return self.connected
 
-    def start(self):
+    def start(self, client=None):
         try:
             self.host = socket.gethostbyname(self.host)
         except:
             self.logger.fatal("%s not discovered", self.host)
             return False
         self.logger.info("discovered homeassistant with IP=%s", self.host)
-        self.client = mqtt.Client()
+        if client is None:
+            # with a fixed client id the broker keeps our session, a reconnect then only needs a delta
+            client_id = self.hobby.get_config("hass_client_id") or ""
+            client = mqtt.Client(client_id=client_id, clean_session=not client_id)
+        self.client = client
+        self.client.will_set(self.availability_topic, "offline", qos=1, retain=True)
         self.client.on_message = self.message
         self.client.on_connect = self.connect
         self.client.on_disconnect = self.disconnect
-        self.client.connect_async(self.host, self.port)
-        self.connect_timer = threading.Timer(self.connect_timeout, self._connect_timeout_handler)
-        self.connect_timer.start()
-        self.client.loop_start()
+        self.publisher = HassPublisher(self.logger, self.client, self.runtime,
+                                       rate=self.hobby.get_config("hass_publish_rate", 50),
+                                       window=self.hobby.get_config("hass_publish_window", 10),
+                                       coalesce=self.hobby.get_config("hass_state_coalesce", 0))
+        self.publisher.fingerprints = HassFingerprints(self.logger, self.runtime, self.hobby.get_config("hass_fingerprint_file"))
+        self.seed_fingerprints = self.hobby.get_config("hass_seed_fingerprints", False)
+        self.publisher.on_idle = self._check_discovery_complete
+        self.publisher.metrics = self.hobby.metrics
+        self._describe_metrics()
+        self.light = HassLight(self.logger, self.publisher, self.hobby)
+        self.switch = HassSwitch(self.logger, self.publisher, self.hobby)
+        self.switch_mood = HassSwitchMood(self.logger, self.publisher, self.hobby)
+        self.cover = HassCover(self.logger, self.publisher, self.hobby)
+        self.fan = HassFan(self.logger, self.publisher, self.hobby)
+        self.binary_sensor = HassBinarySensor(self.logger, self.publisher, self.hobby)
+        self._handlers = {
+            "light": self.light,
+            "switch": self.switch,
+            "switch_mood": self.switch_mood,
+            "cover": self.cover,
+            "fan": self.fan,
+            "binary_sensor": self.binary_sensor,
+        }
+        self.client.on_publish = self.publisher.on_publish
+        self.publisher.start()
+        self.connect_timer = self.runtime.call_later(self.connect_timeout, self._connect_timeout_handler)
+        self.runtime.connect(self.client, self.host, self.port)
+        return True
+
+
+    def _describe_metrics(self):
+        metrics = self.hobby.metrics
+        metrics.counter("hass_messages_total", "MQTT messages received from the HA broker per topic")
+        metrics.counter("hass_publishes_total", "Publishes towards HA per entity type")
+        metrics.counter("hass_suppressed_total", "State publishes suppressed because nothing changed")
+        metrics.histogram("nhc_to_hass_seconds", "Latency from an NHC status event to the HA state publish")
+        metrics.gauge("hass_publish_pending", "Discovery messages queued or waiting for an ack", self.publisher.pending)
 
 
     def stop(self):
+        if self.publisher is None:
+            return
+        if self.connected:
+            # a clean disconnect does not fire the last will
+            self.client.publish(self.availability_topic, "offline", qos=1, retain=True)
         self.connected = False
-        self.client.disconnect()
+        self.publisher.stop()
+        self.runtime.disconnect(self.client)
     
 
     def message(self, client, obj, msg):
-        self.logger.info("HASS mqtt message topic:%s\n%s", msg.topic, msg.payload)
-        if msg.topic == "homeassistant/status":
-            self.hass_status(msg.payload)
-        elif msg.topic.endswith("set"):
-            self.hass_set(client, msg)
-        elif msg.topic.endswith("state") or msg.topic.endswith("available"):
-            # skip messages send ourself towards hass
-            pass
+        self.logger.debug("HASS mqtt message topic:%s\n%s", msg.topic, msg.payload)
+        if self.hobby.recorder is not None:
+            self.hobby.recorder.record(SOURCE_HASS, msg.topic, msg.payload)
+        handler = self._topic_handlers.get(msg.topic)
+        if handler is not None:
+            self.hobby.metrics.inc("hass_messages_total", {"topic": msg.topic})
+            handler(msg.payload, msg.retain)
+            return
+        subscription, handler = self._segment_handlers.get(msg.topic.rpartition("/")[2], (None, None))
+        if handler is not None:
+            self.hobby.metrics.inc("hass_messages_total", {"topic": subscription})
+            handler(client, msg)
         else:
             self.logger.info("hass mqtt message '%s' on topic: %s", msg.payload, msg.topic)
 
 
     def connect(self, client, obj, flags, rc):
+        if rc != 0:
+            # refused, the runtime retries
+            self.logger.warning("Connection to hass broker refused. rc:%d", rc)
+            return
         self.connected = True
         self.connect_timer.cancel()
         self.logger.info("Connected to hass broker. rc:%d", rc)
-        self.light = HassLight(self.logger, self.client, self.hobby)
-        self.switch = HassSwitch(self.logger, self.client, self.hobby)
-        self.switch_mood = HassSwitchMood(self.logger, self.client, self.hobby)
-        self.cover = HassCover(self.logger, self.client, self.hobby)
-        self.fan = HassFan(self.logger, self.client, self.hobby)
-        self.binary_sensor = HassBinarySensor(self.logger, self.client, self.hobby)
-        self.client.subscribe("#", 0)
+        reconnect = self.pipeline.is_set(STAGE_HASS_CONNECTED)
+        if reconnect:
+            self.hobby.metrics.inc("mqtt_reconnects_total", {"broker": "hass"})
+        self.pipeline.mark(STAGE_HASS_CONNECTED)
+        self.client.subscribe([(TOPIC_HASS_STATUS, self.qos), (TOPIC_HASS_SET, self.qos)])
+        self.client.publish(self.availability_topic, "online", qos=1, retain=True)
+        self._flush_removed()
+        resumed = bool(flags and flags.get("session present"))
+        if reconnect and resumed:
+            # the broker kept our session and its retained messages
+            self._resync_states()
+            return
+        self.publisher.forget_state()
+        # retained configs outlive the session but not a broker that lost its store,
+        # fingerprints from an earlier connection or run are checked against what the broker holds
+        if self.seed_fingerprints or reconnect or self.publisher.fingerprints.loaded:
+            self._seed_fingerprints()
+        else:
+            self._publish_known_devices()
+
+
+    def _registry_loaded(self):
+        if self.workqueue is not None:
+            # the devices are still on their way through the work queue
+            self.workqueue.barrier(self._registry_queued)
+        else:
+            self._registry_queued()
+
+
+    def _registry_queued(self):
+        # every device of the registry reached the publisher, an idle publisher now means done
+        self._registry_drained = True
+        self._check_discovery_complete()
+
+
+    def _check_discovery_complete(self):
+        if not self._registry_drained or not self.connected:
+            return
+        if self.publisher.pending() == 0:
+            self.pipeline.mark(STAGE_DISCOVERY_COMPLETE)
+
+
+    def _publish_known_devices(self):
+        loaded = self.pipeline.is_set(STAGE_REGISTRY_LOADED)
+        if loaded:
+            self._registry_drained = False
+        for gateway in self.hobby.gateways:
+            if len(gateway.devices) > 0:
+                # devices known from the snapshot, publish them before the live list arrives
+                gateway.status_add_all()
+        if loaded:
+            # discovery is complete once these adds went through the work queue too
+            self._registry_loaded()
+
+
+    def _hass_devices(self):
+        for gateway in self.hobby.gateways:
+            for device in gateway.hass_devices():
+                yield gateway, device
+
+
+    def _owner(self, object_id):
+        # the gateway and NHC uuid behind an HA object id, the named gateways are matched on their prefix first
+        for gateway in self.hobby.gateways[1:] + self.hobby.gateways[:1]:
+            uuid = gateway.uuid_of(object_id)
+            if uuid is not None:
+                return gateway, uuid
+
+
+    def _find(self, object_id):
+        gateway, uuid = self._owner(object_id)
+        return gateway, gateway.search_uuid_action(uuid, NHC_MODELS.ALL)
+
+
+    def gateway_callbacks(self, gateway):
+        # the set_callbacks arguments for an extra gateway
+        return (lambda device, changes: self.nhc_status_update(device, changes, gateway),
+                lambda uuid, model: self.nhc_remove_device(uuid, model, gateway),
+                lambda device: self.nhc_add_device(device, gateway))
+
+
+    def _seed_fingerprints(self):
+        # the retained configs on the broker are the truth, read them once after connecting
+        self.publisher.fingerprints.reset()
+        self.client.subscribe(TOPIC_HASS_CONFIG, 0)
+        self.runtime.call_later(self.seed_fingerprints_time, self._seed_fingerprints_done)
+
+
+    def _seed_fingerprints_done(self):
+        self.client.unsubscribe(TOPIC_HASS_CONFIG)
+        self.logger.info("discovery fingerprints seeded from the broker")
+        self._publish_known_devices()
+
+
+    def _resync_states(self):
+        # publish only the states that changed while we were away, new devices get a full discovery
+        added = 0
+        for gateway, device in self._hass_devices():
+            entity = self.entities.get(gateway.object_id(device["Uuid"]))
+            if entity is None:
+                self.nhc_add_device(device, gateway)
+                added += 1
+                continue
+            entity.update(device, None)
+        self.logger.info("hass resynced, %d devices discovered", added)
+        self._check_discovery_complete()
+
+
+    def _flush_removed(self):
+        removed, self._removed_offline = self._removed_offline, {}
+        for gateway, uuid, model in removed.values():
+            self.nhc_remove_device(uuid, model, gateway)
 
 
     def disconnect(self, client, userdata, rc):
@@ -91,13 +277,15 @@ class Hass(object):
         self.connect_timer.cancel()
 
 
-    def hass_status(self, payload):
+    def hass_status(self, payload, retained=False):
         payload = payload.decode('ascii')
         if payload == "online":
             self.hass_online = True
             self.logger.warning("Home Assistant online")
-            self.discover_all()
-            # todo pass all nhc states towards hass
+            if retained or not self.pipeline.is_set(STAGE_DISCOVERY_COMPLETE):
+                # not a restart of HA, our own (re)connect already sends the states
+                return
+            self.resync_from_cache()
         elif payload == "offline":
             self.logger.warning("Home Assistant offline")
             # set all entities available, retained, so that this data is present when HA needs it
@@ -106,162 +294,237 @@ class Hass(object):
         pass
 
 
+    def resync_from_cache(self):
+        # HA reads the retained configs itself after a restart, it only misses the states
+        states = added = 0
+        for gateway, device in self._hass_devices():
+            entity = self.entities.get(gateway.object_id(device["Uuid"]))
+            if entity is None:
+                if device["HassEnabled"] is not False and self.nhc_add_device(device, gateway) is not False:
+                    added += 1
+                continue
+            if not entity.handler.restate:
+                continue
+            state = entity.handler.state(entity, device)
+            if state is not None:
+                self.publisher.enqueue_state(entity.state_topic, state)
+                states += 1
+        self.logger.info("Home Assistant resynced from cache: %d states, %d devices discovered", states, added)
+
+
+    def hass_config(self, client, msg):
+        self.publisher.fingerprints.seed(msg.topic, msg.payload)
+
+
     def hass_set(self, client, msg):
         topic_split = msg.topic.split("/")
-        hass_type = topic_split[1]
-        uuid = topic_split[2]
-        if hass_type == "light":
-            self.light.set(uuid, msg.payload)
-        elif hass_type == "switch" or hass_type == "switch_mood":
-            self.switch.set(uuid, msg.payload)
-        elif hass_type == "cover":
-            self.cover.set(uuid, msg.payload)
-        elif hass_type == "fan":
-            self.fan.set(uuid, msg.payload)
-        elif hass_type == "binary_sensor":
-            self.binary_sensor.set(uuid, msg.payload)
+        entity = self.entities.get(topic_split[2])
+        if entity is None:
+            handler = self._handlers.get(topic_split[1])
+            if handler is None:
+                return
+            gateway, uuid = self._owner(topic_split[2])
+            entity = HassEntity(uuid, topic_split[1], handler, gateway=gateway)
+        self.hobby.metrics.mark("hass_set", entity.uuid)
+        entity.handler.set(entity, msg.payload)
 
 
     def nhc_to_hass_model(self, nhc_model):
-        if nhc_model in ["light", "dimmer"]:
-            return "light"
-        elif nhc_model in ["rolldownshutter", "sunblind", "gate", "venetianblind"]:
-            return "cover"
-        elif nhc_model == "switched-fan":
-            return "fan"
-        elif nhc_model in ["socket", "switched-generic"]:
-            return "switch"
-        elif nhc_model in ["pir", "comfort", "overallcomfort", "alloff", "generic"]:
-            return "switch_mood"
-        elif nhc_model in ["alarms", "simulation", "timeschedule", "condition"]:
+        if nhc_model in NHC_UNSUPPORTED_MODELS:
             self.logger.info("NHC model '%s' not supported in Hass", nhc_model)
+        return nhc_to_hass_model(nhc_model)
+
+
+    def _entity(self, device, gateway):
+        # built once per device, the status hot path only looks it up
+        object_id = gateway.object_id(device["Uuid"])
+        hass_model = self.nhc_to_hass_model(device["Model"])
+        entity = self.entities.get(object_id)
+        if entity is not None and entity.hass_model == hass_model:
+            return entity
+        handler = self._handlers.get(hass_model)
+        if handler is None:
             return None
+        entity = HassEntity(device["Uuid"], hass_model, handler, device, gateway)
+        self.entities[object_id] = entity
+        return entity
 
 
-    def discover(self, uuid):
-        device = self.hobby.search_uuid_action(uuid, NHC_MODELS.ALL)
+    def discover(self, object_id):
+        gateway, device = self._find(object_id)
         if device is None:
             self.logger.info("device not found")
             return False
         if device["HassEnabled"] is False:
             self.logger.info("'%s' disabled for discovering in Hass", device["Name"])
             return False
-        self.nhc_add_device(device)
+        self.nhc_add_device(device, gateway)
 
 
     def discover_all(self):
-        self.hobby.devices_list_get()
-        _list = self.hobby.list_uuid_action()
+        # never block on the response, it may arrive on the thread calling us
+        for gateway in self.hobby.gateways:
+            gateway.devices_list_get().add_done_callback(lambda future, gateway=gateway: self._discover_listed(gateway, future))
+
+
+    def _discover_listed(self, gateway, future):
+        if future.exception() is not None:
+            self.logger.warning("devices list not refreshed: %s", future.exception())
+        _list = gateway.list_uuid_action()
+        self.logger.info("queueing discovery of %d devices", len(_list))
         for uuid in _list:
-            time.sleep(0.1)
-            self.discover(uuid)
+            self.discover(gateway.object_id(uuid))
 
 
-    def remove(self, uuid, model):
+    def remove(self, object_id, model):
+        entity = self.entities.get(object_id)
+        if entity is not None:
+            self.publisher.remove_config(entity.config_topic)
+            return
+        gateway, device = self._find(object_id)
         if model is None:
-            device = self.hobby.search_uuid_action(uuid, NHC_MODELS.ALL)
             if device is not None:
                 model = self.nhc_to_hass_model(device["Model"])
             else:
                 return
-        topic = "homeassistant/" + model + "/" + uuid + "/config"
-        self.client.publish(topic, '')
+        handler = self._handlers.get(model)
+        if handler is None:
+            return
+        self.publisher.remove_config(HassEntity(object_id, model, handler).config_topic)
 
 
     def remove_all(self):
-        _list = self.hobby.list_uuid_action()
-        for uuid in _list:
-            time.sleep(0.1)
-            self.remove(uuid, None)
+        for gateway in self.hobby.gateways:
+            for uuid in gateway.list_uuid_action():
+                self.remove(gateway.object_id(uuid), None)
 
 
-    def nhc_status_update(self, device):
-        hass_model = self.nhc_to_hass_model(device["Model"])
-        if hass_model is None:
+    def nhc_status_update(self, device, changes, gateway=None):
+        if not changes or not self.connected:
+            return
+        if gateway is None:
+            gateway = self.hobby
+        entity = self.entities.get(gateway.object_id(device["Uuid"]))
+        if entity is None:
+            entity = self._entity(device, gateway)
+            if entity is None:
+                return
+        if "Online" in changes and self.device_availability:
+            entity.handler.availability(entity, self._device_online(device))
+        if entity.update(device, changes):
+            # unchanged, suppressed or failed states would only add near-zero samples
+            self.hobby.metrics.observe_since("nhc_to_hass_seconds", "nhc_event", entity.uuid, {"entity": entity.hass_model})
+
+
+    def nhc_remove_device(self, uuid, model, gateway=None):
+        if gateway is None:
+            gateway = self.hobby
+        object_id = gateway.object_id(uuid)
+        if not self.connected:
+            # the config removal would be lost, send it after the reconnect
+            self._removed_offline[object_id] = (gateway, uuid, model)
             return
-        if hass_model == "light":
-            self.light.update(device)
-        elif hass_model == "switch":
-            self.switch.update(device)
-        elif hass_model == "switch_mood":
-            self.switch_mood.update(device)
-        elif hass_model == "cover":
-            self.cover.update(device)
-        elif hass_model == "fan":
-            self.fan.update(device)
-
-
-    def nhc_remove_device(self, uuid, model):
-        hass_model = self.nhc_to_hass_model(model)
-        topic = "homeassistant/" + hass_model + "/" + uuid + "/config"
-        self.client.publish(topic, '')
-
-
-    def discover_frame(self, device):
-        location = device["Parameters"][0]["LocationName"]
+        entity = self.entities.pop(object_id, None)
+        if entity is None:
+            hass_model = self.nhc_to_hass_model(model)
+            handler = self._handlers.get(hass_model)
+            if handler is None:
+                return
+            entity = HassEntity(uuid, hass_model, handler, gateway=gateway)
+        self.publisher.remove_config(entity.config_topic)
+        self.publisher.forget_state(entity.state_topic)
+
+
+    def discover_frame(self, device, gateway=None):
+        if gateway is None:
+            gateway = self.hobby
+        location = gateway.devices.location(device["Uuid"])
         _hass_name = device["Name"]
-        if _hass_name.find(location) == -1:
+        if location is not None and _hass_name.find(location) == -1:
             _hass_name = _hass_name + " " + location
-        _gateway_info = self.hobby.nhc_info()
+        _gateway_info = gateway.nhc_info()
+        _gateway_name = "NHC" if gateway.name is None else "NHC " + gateway.name
+        _gateway_id = gateway.object_id(_gateway_info["gateway_name"])
         frame_device = {}
-        frame_device["name"] = "NHC"
-        frame_device["identifiers"] = [_gateway_info["gateway_name"]]
+        if self.area_devices and location is not None:
+            frame_device["name"] = _gateway_name + " " + location
+            frame_device["identifiers"] = [_gateway_id + "_" + location]
+            frame_device["suggested_area"] = location
+            if self._gateway_device_published(gateway):
+                frame_device["via_device"] = _gateway_id
+        else:
+            frame_device["name"] = _gateway_name
+            frame_device["identifiers"] = [_gateway_id]
         frame_device["manufacturer"] = "Niko"
         frame_device["model"] = _gateway_info["hubtype"]
         frame_device["sw_version"] = _gateway_info["firmware"]
         frame = {}
         frame["name"] = _hass_name
-        frame["unique_id"] = device["Uuid"]
+        frame["unique_id"] = gateway.object_id(device["Uuid"])
         frame["device"] = frame_device
         frame["command_topic"] = "~/set"
         frame["state_topic"] = "~/state"
-        frame["availability_topic"] = "~/available"
+        if self.device_availability:
+            frame["availability"] = [{"topic": self.availability_topic}, {"topic": "~/available"}]
+            frame["availability_mode"] = "all"
+        else:
+            frame["availability_topic"] = self.availability_topic
         return frame
 
 
-    def nhc_add_device(self, device):
-        hass_model = self.nhc_to_hass_model(device["Model"])
-        if hass_model is None:
+    def _gateway_device_published(self, gateway):
+        # with area devices the gateway only exists in HA while a device without location is published on it
+        hass_models = gateway.hass_models()
+        for device in gateway.devices.unlocated():
+            if device.get("Type") == "action" and device.get("Model") in hass_models and device.get("HassEnabled") is not False:
+                return True
+        return False
+
+
+    def _device_online(self, device):
+        return "online" if device.get("Online", "True") == "True" else "offline"
+
+
+    def nhc_add_device(self, device, gateway=None):
+        if not self.connected:
+            # connect publishes every known device
             return False
-        _base_frame = self.discover_frame(device)
-        if hass_model == "light":
-            self.light.discover(device, _base_frame)
-        elif hass_model == "switch":
-            self.switch.discover(device, _base_frame)
-        elif hass_model == "switch_mood":
-            self.switch_mood.discover(device, _base_frame)
-        elif hass_model == "cover":
-            self.cover.discover(device, _base_frame)
-        elif hass_model == "fan":
-            self.fan.discover(device, _base_frame)
-        elif hass_model == "binary_sensor":
-            self.binary_sensor.discover(device, _base_frame)
-
-
-    def availability(self, uuid, mode=True):
-        device = self.hobby.search_uuid_action(uuid, NHC_MODELS.ALL)
+        if gateway is None:
+            gateway = self.hobby
+        entity = self._entity(device, gateway)
+        if entity is None:
+            return False
+        # a rediscovery may come with other properties, rebuild the templates
+        entity.handler.prepare(entity, device)
+        _base_frame = self.discover_frame(device, gateway)
+        entity.handler.discover(entity, device, _base_frame)
+        if self.device_availability:
+            self.publisher.enqueue(entity.available_topic, self._device_online(device), retain=True)
+
+
+    def availability(self, object_id, mode=True):
+        gateway, device = self._find(object_id)
         if device is None:
             self.logger.info("device not found")
             return False
+        if not self.device_availability:
+            self.logger.info("per device availability is disabled, see hass_device_availability")
+            return False
         if mode:
             mode = "online"
         else:
             mode = "offline"
-        hass_model = self.nhc_to_hass_model(device["Model"])
-        if hass_model == "light":
-            self.light.availability(device["Uuid"], mode)
-        elif hass_model == "switch" and "switch_mood":
-            self.switch.availability(device["Uuid"], mode)
-        elif hass_model == "cover":
-            self.cover.availability(device["Uuid"], mode)
-        elif hass_model == "fan":
-            self.fan.availability(device["Uuid"], mode)
-        elif hass_model == "binary_sensor":
-            self.binary_sensor.availability(device["Uuid"], mode)
+        entity = self._entity(device, gateway)
+        if entity is None:
+            return False
+        entity.handler.availability(entity, mode)
 
 
     def set_all_available(self):
-        _list = self.hobby.list_uuid_action()
-        for uuid in _list:
-            time.sleep(0.1)
-            self.availability(uuid)
+        self.client.publish(self.availability_topic, "online", qos=1, retain=True)
+        if not self.device_availability:
+            return
+        for gateway, device in self._hass_devices():
+            entity = self.entities.get(gateway.object_id(device["Uuid"]))
+            if entity is not None:
+                self.publisher.enqueue(entity.available_topic, self._device_online(device), retain=True)
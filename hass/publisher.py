@@ -0,0 +1,263 @@
+import asyncio
+import threading
+import queue
+import time
+
+
+KIND_STATE = "state"
+KIND_CONFIG = "config"
+
+
+class HassPublisher(object):
+    def __init__(self, logger, client, runtime, rate=50, window=10, ack_timeout=5, progress_every=100, coalesce=0):
+        self.logger = logger
+        self.client = client
+        self.runtime = runtime
+        self.rate = rate
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.progress_every = progress_every
+        self.coalesce = coalesce
+        self.fingerprints = None
+        self.metrics = None
+        self.on_idle = None
+        self.suppressed = 0
+        self._last_state = {}
+        self._pending_state = {}
+        self._state_lock = threading.Lock()
+        if self.runtime.is_async:
+            self._queue = asyncio.Queue()
+            self._acked = asyncio.Event()
+        else:
+            self._queue = queue.Queue()
+        self._inflight = {}
+        # counted when enqueued, the asyncio queue only sees an item after call_soon ran
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._sending = False
+        self._early_acks = set()
+        self._thread = None
+        self._batch_start = None
+        self._batch_count = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.runtime.is_async:
+            self._thread = self.runtime.create_task(self._async_worker())
+            return
+        self._thread = threading.Thread(target=self._worker, name="hass-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._put(None)
+        self._thread = None
+
+    def _put(self, item):
+        if item is not None:
+            with self._cond:
+                self._queued += 1
+        if self.runtime.is_async:
+            self.runtime.call_soon(self._queue.put_nowait, item)
+        else:
+            self._queue.put(item)
+
+    def publish(self, topic, payload=None, retain=False):
+        # direct publish, used for realtime state updates
+        return self.client.publish(topic, payload, retain=retain)
+
+    def enqueue(self, topic, payload=None, retain=False, kind=None):
+        # paced publish, used for bulk discovery traffic
+        self._put((topic, payload, retain, kind))
+
+    def enqueue_config(self, topic, payload):
+        # retained discovery config, skipped when the broker already holds this exact payload
+        if self.fingerprints is not None and not self.fingerprints.changed(topic, payload):
+            return False
+        self.enqueue(topic, payload, retain=True, kind=KIND_CONFIG)
+        return True
+
+    def remove_config(self, topic):
+        if self.fingerprints is not None:
+            self.fingerprints.forget(topic)
+        self.enqueue(topic, '', retain=True)
+
+    def enqueue_state(self, topic, payload):
+        # discovery always sends the state, it becomes the reference for suppression once sent
+        self.enqueue(topic, payload, kind=KIND_STATE)
+
+    def publish_state(self, topic, payload):
+        # skip states identical to the last published one, optionally coalesce bursts
+        with self._state_lock:
+            if self.coalesce:
+                if topic not in self._pending_state:
+                    self.runtime.call_later(self.coalesce, self._flush_state, topic)
+                self._pending_state[topic] = payload
+                return True
+            if self._last_state.get(topic) == payload:
+                self._suppress(topic)
+                return False
+        return self._publish_state(topic, payload)
+
+    def _suppress(self, topic):
+        self.suppressed += 1
+        self.logger.debug("suppressed unchanged state on %s", topic)
+        if self.metrics is not None:
+            self.metrics.inc("hass_suppressed_total")
+
+    def _count(self, topic):
+        # topics are homeassistant/<entity type>/<uuid>/<suffix>
+        if self.metrics is not None:
+            self.metrics.inc("hass_publishes_total", {"entity": topic.split("/")[1]})
+
+    def _flush_state(self, topic):
+        with self._state_lock:
+            payload = self._pending_state.pop(topic, None)
+            if payload is None:
+                return
+            if self._last_state.get(topic) == payload:
+                self._suppress(topic)
+                return
+        self._publish_state(topic, payload)
+
+    def _publish_state(self, topic, payload):
+        info = self.client.publish(topic, payload)
+        self._state_sent(topic, payload, info.rc)
+        if info.rc != 0:
+            return False
+        self._count(topic)
+        return True
+
+    def _state_sent(self, topic, payload, rc):
+        # only a state the client accepted may suppress an identical one later
+        with self._state_lock:
+            if rc == 0:
+                self._last_state[topic] = payload
+            else:
+                self._last_state.pop(topic, None)
+
+    def forget_state(self, topic=None):
+        with self._state_lock:
+            if topic is None:
+                self._last_state = {}
+            else:
+                self._last_state.pop(topic, None)
+
+    def pending(self):
+        with self._cond:
+            return self._queued + len(self._inflight)
+
+    def on_publish(self, client, userdata, mid):
+        idle = False
+        item = None
+        with self._cond:
+            item = self._inflight.pop(mid, None)
+            if item is not None:
+                self._cond.notify()
+                if self.runtime.is_async:
+                    # on_publish runs on the event loop in the asyncio runtime
+                    self._acked.set()
+                idle = not self._inflight and self._queued == 0
+            elif self._sending:
+                # acked from within client.publish, before the mid is known
+                self._early_acks.add(mid)
+        if item is not None:
+            self._acked_item(*item)
+        if idle and self.on_idle is not None:
+            # the last discovery message of a batch got its ack
+            self.on_idle()
+
+    def _wait_window(self):
+        with self._cond:
+            while len(self._inflight) >= self.window:
+                if not self._cond.wait(timeout=self.ack_timeout):
+                    self.logger.warning("no publish ack within %ds for %d messages", self.ack_timeout, len(self._inflight))
+                    self._inflight.clear()
+
+    def _send(self, topic, payload, retain, kind=None):
+        # paho holds its own lock while calling on_publish, so publish without ours;
+        # an ack that overtakes the bookkeeping is kept in _early_acks while _sending is set.
+        # retained messages go at QoS 1, so the window waits for the broker's ack, not the socket write
+        with self._cond:
+            self._queued -= 1
+            self._sending = True
+        info = None
+        try:
+            info = self.client.publish(topic, payload, qos=1 if retain else 0, retain=retain)
+        finally:
+            with self._cond:
+                self._sending = False
+                acked = info is not None and info.mid in self._early_acks
+                self._early_acks.clear()
+                if info is not None and info.rc == 0 and not acked:
+                    self._inflight[info.mid] = (topic, payload, kind)
+        if kind == KIND_STATE:
+            self._state_sent(topic, payload, info.rc)
+        if info.rc != 0:
+            self.logger.warning("publish on %s failed (rc:%d)", topic, info.rc)
+            if kind == KIND_CONFIG and self.fingerprints is not None:
+                self.fingerprints.forget(topic)
+            return
+        self._count(topic)
+        if acked:
+            self._acked_item(topic, payload, kind)
+
+    def _acked_item(self, topic, payload, kind):
+        # the broker holds this config now, an identical one can be skipped from here on
+        if kind == KIND_CONFIG and self.fingerprints is not None:
+            self.fingerprints.record(topic, payload)
+
+    async def _async_wait_window(self):
+        while len(self._inflight) >= self.window:
+            self._acked.clear()
+            try:
+                await asyncio.wait_for(self._acked.wait(), self.ack_timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning("no publish ack within %ds for %d messages", self.ack_timeout, len(self._inflight))
+                with self._cond:
+                    self._inflight.clear()
+
+    def _batch_begin(self):
+        if self._batch_start is None:
+            self._batch_start = time.monotonic()
+            self._batch_count = 0
+
+    def _batch_sent(self):
+        self._batch_count += 1
+        if self._batch_count % self.progress_every == 0:
+            self.logger.info("discovery publish progress: %d sent, %d queued", self._batch_count, self._queued)
+        if self._queued == 0:
+            elapsed = time.monotonic() - self._batch_start
+            self.logger.info("discovery publish done: %d messages in %.2fs", self._batch_count, elapsed)
+            self._batch_start = None
+            if self.on_idle is not None:
+                self.on_idle()
+
+    def _worker(self):
+        interval = 0 if not self.rate else 1.0 / self.rate
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._batch_begin()
+            self._wait_window()
+            self._send(*item)
+            self._batch_sent()
+            if interval:
+                time.sleep(interval)
+
+    async def _async_worker(self):
+        # same pacing as _worker, but yields to the event loop instead of sleeping
+        interval = 0 if not self.rate else 1.0 / self.rate
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            self._batch_begin()
+            await self._async_wait_window()
+            self._send(*item)
+            self._batch_sent()
+            if interval:
+                await asyncio.sleep(interval)
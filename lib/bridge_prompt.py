@@ -6,11 +6,12 @@ from cmd2 import style, ansi
 
 
 class prompt(cli.Cmd):
-    def __init__(self, clilogger, nhccontrol, hass):
+    def __init__(self, clilogger, nhccontrol, hass, workqueue=None):
         super().__init__(allow_cli_args=False)
         self.clilogger = clilogger
         self.nhccontrol = nhccontrol
         self.hass = hass
+        self.workqueue = workqueue
         self.prompt = style('NHC> ', fg='blue', bold=True)
         self.self_in_py = True
         self.default_category = 'cmd2 Built-in Commands'
@@ -27,8 +28,12 @@ class prompt(cli.Cmd):
     devices_parser = argparse.ArgumentParser(description="Print devices in a filtered table")
     devices_parser.add_argument('-m', '--model', help='Filter NHC model')
     devices_parser.add_argument('-t', '--type', help='Filter NHC type')
-    devices_parser.add_argument('-s', '--sort', help='Sort by', choices=['Name','Location','Model','Type','UUID'], default="Name")
+    devices_parser.add_argument('-l', '--location', help='Filter NHC location')
+    devices_parser.add_argument('-s', '--sort', help='Sort by', choices=['Name','Location','Model','Type','UUID','MAC','Channel','Online'], default="Name")
     devices_parser.add_argument('-f', '--full', help='Print full table', action='store_true', default=False)
+    devices_parser.add_argument('-n', '--limit', help='Devices per page', type=int)
+    devices_parser.add_argument('-p', '--page', help='Page to print, with --limit', type=int, default=1)
+    devices_parser.add_argument('-o', '--output', help='Output format', choices=['table', 'csv', 'json'], default="table")
 
     @cli.with_argparser(devices_parser)
     @cli.with_category("NHC")
@@ -36,7 +41,16 @@ class prompt(cli.Cmd):
         if args.model is not None:
             args.model = [args.model]
         _table = self.nhccontrol.hobby.print_devices(
-            filtermodel=args.model, filtertype=args.type, fulltable=args.full, sortby=args.sort)
+            filtermodel=args.model, filtertype=args.type, fulltable=args.full, sortby=args.sort, filterlocation=args.location,
+            limit=args.limit, page=args.page, output=args.output)
+        self.clilogger.cli_info(_table)
+
+    locations_parser = argparse.ArgumentParser(description="Print locations and their number of devices")
+
+    @cli.with_argparser(locations_parser)
+    @cli.with_category("NHC")
+    def do_locations(self, args):
+        _table = self.nhccontrol.hobby.print_locations()
         self.clilogger.cli_info(_table)
 
     properties_parser = argparse.ArgumentParser(description="Print properties of a device")
@@ -105,6 +119,31 @@ class prompt(cli.Cmd):
         if args.uuid is not None:
             self.nhccontrol.motor(args.uuid, args.action, args.position)
 
+    bulk_parser = argparse.ArgumentParser(description="Control many devices in one frame")
+    bulk_parser.add_argument('-u', '--uuid', help='NHC UUID devices', nargs='+')
+    bulk_parser.add_argument('-m', '--model', help='Filter NHC model or relay/dimmer/motor/mood', nargs='+')
+    bulk_parser.add_argument('-l', '--location', help='Filter NHC location')
+    bulk_parser.add_argument('-p', '--property', help='Property, e.g. Status, Brightness, Action', required=True)
+    bulk_parser.add_argument('-s', '--value', help='Value, e.g. On, Off, 50, Open', required=True)
+    bulk_parser.add_argument('-v', '--view', help='View table with selected devices', action='store_true')
+
+    @cli.with_argparser(bulk_parser)
+    @cli.with_category("NHC")
+    def do_bulk(self, args):
+        hobby = self.nhccontrol.hobby
+        if args.uuid is not None:
+            _list = args.uuid
+        elif args.model is not None or args.location is not None:
+            _list = hobby.search_actions(args.model, args.location)
+        else:
+            self.clilogger.cli_warning("specify uuids or a model/location filter")
+            return
+        if args.view:
+            for uuid in _list:
+                self.clilogger.cli_neutral(uuid)
+        self.clilogger.cli_info("%s=%s on %d devices" % (args.property, args.value, len(_list)))
+        self.nhccontrol.bulk(_list, {args.property: args.value})
+
     discover_parser = argparse.ArgumentParser(description="Discover entities")
     discover_parser.add_argument('-u', '--uuid', help='NHC UUID device')
     discover_parser.add_argument('-v', '--view', help='View table with actions', action='store_true')
@@ -136,6 +175,18 @@ class prompt(cli.Cmd):
             self.hass.remove(args.uuid, args.model)
 
 
+    queue_parser = argparse.ArgumentParser(description="Show the NHC to Hass work queue")
+
+    @cli.with_argparser(queue_parser)
+    @cli.with_category("Hass")
+    def do_queue(self, args):
+        if self.workqueue is None:
+            self.clilogger.cli_warning("no work queue")
+            return
+        stats = self.workqueue.stats()
+        self.clilogger.cli_info("depth:%d high-water:%d dropped:%d policy:%s" % (
+            stats["depth"], stats["high_water"], stats["dropped"], stats["policy"]))
+
     availability_parser = argparse.ArgumentParser(description="Set entity availability")
     availability_parser.add_argument('-u', '--uuid', help='NHC UUID device')
     availability_parser.add_argument('-d', '--disable', help='NHC UUID device', action='store_true', default=False)
@@ -0,0 +1,162 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def _labels_key(labels):
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
+
+
+def _labels_text(key, extra=None):
+    items = list(key)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in items) + "}"
+
+
+class metricsRegistry(object):
+    # in-process counters, histograms and gauges, rendered in the Prometheus text format
+    def __init__(self, logger):
+        self.logger = logger
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._gauges = {}
+        self._marks = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def counter(self, name, help):
+        self._help[name] = help
+        self._counters.setdefault(name, {})
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._help[name] = help
+        self._buckets[name] = buckets
+        self._histograms.setdefault(name, {})
+
+    def gauge(self, name, help, source):
+        # source is called at scrape time and returns the current value
+        self._help[name] = help
+        self._gauges[name] = source
+
+    def inc(self, name, labels=None, value=1):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def get(self, name, labels=None):
+        with self._lock:
+            return self._counters.get(name, {}).get(_labels_key(labels), 0)
+
+    def total(self, name):
+        # sum of a counter over all its labels
+        with self._lock:
+            return sum(self._counters.get(name, {}).values())
+
+    def observe(self, name, value, labels=None):
+        key = _labels_key(labels)
+        buckets = self._buckets.setdefault(name, LATENCY_BUCKETS)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = {"counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    entry["counts"][index] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def mark(self, kind, key):
+        # start of a latency measurement that completes in another part of the bridge
+        with self._lock:
+            self._marks[(kind, key)] = time.monotonic()
+
+    def observe_since(self, name, kind, key, labels=None):
+        with self._lock:
+            started = self._marks.pop((kind, key), None)
+        if started is None:
+            return None
+        elapsed = time.monotonic() - started
+        self.observe(name, elapsed, labels)
+        return elapsed
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = dict((name, dict(series)) for name, series in self._counters.items())
+            histograms = dict((name, dict((key, {"counts": list(entry["counts"]), "sum": entry["sum"], "count": entry["count"]})
+                                          for key, entry in series.items())) for name, series in self._histograms.items())
+        for name in sorted(counters):
+            self._render_header(lines, name, "counter")
+            for key, value in sorted(counters[name].items()):
+                lines.append("%s%s %s" % (name, _labels_text(key), value))
+        for name in sorted(histograms):
+            self._render_header(lines, name, "histogram")
+            buckets = self._buckets[name]
+            for key, entry in sorted(histograms[name].items()):
+                for bound, count in zip(buckets, entry["counts"]):
+                    lines.append("%s_bucket%s %d" % (name, _labels_text(key, ("le", bound)), count))
+                lines.append("%s_bucket%s %d" % (name, _labels_text(key, ("le", "+Inf")), entry["count"]))
+                lines.append("%s_sum%s %f" % (name, _labels_text(key), entry["sum"]))
+                lines.append("%s_count%s %d" % (name, _labels_text(key), entry["count"]))
+        for name in sorted(self._gauges):
+            try:
+                value = self._gauges[name]()
+            except Exception as exc:
+                self.logger.debug("gauge %s failed: %s", name, exc)
+                continue
+            self._render_header(lines, name, "gauge")
+            lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def _render_header(self, lines, name, kind):
+        if name in self._help:
+            lines.append("# HELP %s %s" % (name, self._help[name]))
+        lines.append("# TYPE %s %s" % (name, kind))
+
+    def start_http(self, port, host="127.0.0.1"):
+        if self._server is not None:
+            return
+        registry = self
+
+        class metricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                registry.logger.debug("metrics: " + format, *args)
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), metricsHandler)
+        except OSError as exc:
+            self.logger.error("metrics endpoint on %s:%d not started: %s", host, port, exc)
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        self.logger.info("metrics endpoint on http://%s:%d/metrics", host, port)
+
+    def stop_http(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
@@ -0,0 +1,90 @@
+import struct
+import threading
+import time
+
+
+RECORD_MAGIC = b"NHCREC1\n"
+RECORD_HEADER = struct.Struct("<dBHI")
+
+SOURCE_NHC = 0
+SOURCE_HASS = 1
+SOURCE_NAMES = {SOURCE_NHC: "nhc", SOURCE_HASS: "hass"}
+
+
+class trafficRecorder(object):
+    # appends every received MQTT message as timestamp, source, topic and payload
+    def __init__(self, logger, runtime, path, flush_interval=1):
+        self.logger = logger
+        self.runtime = runtime
+        self.path = path
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._fp = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._fp is not None:
+            return True
+        try:
+            self._fp = open(self.path, mode='ab')
+            if self._fp.tell() == 0:
+                self._fp.write(RECORD_MAGIC)
+        except OSError as exc:
+            self.logger.error("recording %s not opened: %s", self.path, exc)
+            self._fp = None
+            return False
+        self.logger.info("recording MQTT traffic to %s", self.path)
+        self.runtime.call_later(self.flush_interval, self._periodic_flush)
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._fp is None:
+                return
+            self._fp.close()
+            self._fp = None
+        self.logger.info("recorded %d messages to %s", self.recorded, self.path)
+
+    def record(self, source, topic, payload):
+        topic = topic.encode("utf-8")
+        if payload is None:
+            payload = b''
+        with self._lock:
+            if self._fp is None:
+                return
+            self._fp.write(RECORD_HEADER.pack(time.time(), source, len(topic), len(payload)))
+            self._fp.write(topic)
+            self._fp.write(payload)
+            self._dirty = True
+            self.recorded += 1
+
+    def flush(self):
+        with self._lock:
+            if self._fp is None or not self._dirty:
+                return
+            self._fp.flush()
+            self._dirty = False
+
+    def _periodic_flush(self):
+        if self._fp is None:
+            return
+        self.flush()
+        self.runtime.call_later(self.flush_interval, self._periodic_flush)
+
+
+def read_recording(path):
+    # yields (timestamp, source, topic, payload), a truncated last record is ignored
+    with open(path, mode='rb') as fp:
+        if fp.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError("%s is not a traffic recording" % path)
+        while True:
+            header = fp.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, source, topic_size, payload_size = RECORD_HEADER.unpack(header)
+            topic = fp.read(topic_size)
+            payload = fp.read(payload_size)
+            if len(topic) < topic_size or len(payload) < payload_size:
+                return
+            yield timestamp, source, topic.decode("utf-8"), payload
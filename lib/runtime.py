@@ -0,0 +1,240 @@
+import asyncio
+import random
+import threading
+import paho.mqtt.client as mqtt
+
+
+class reconnectBackoff(object):
+    # exponential delay with jitter, so several clients do not hammer a broker in lockstep
+    def __init__(self, min_delay=1, max_delay=60, jitter=0.25):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._delay = None
+
+    def next(self):
+        if self._delay is None:
+            self._delay = self.min_delay
+        else:
+            self._delay = min(self._delay * 2, self.max_delay)
+        return self._delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def reset(self):
+        self._delay = None
+
+
+class threadTimer(object):
+    def __init__(self, delay, callback, args):
+        self._timer = threading.Timer(delay, callback, args)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def cancel(self):
+        self._timer.cancel()
+
+
+class threadRuntime(object):
+    # default runtime: one paho network thread per client and threading timers
+    is_async = False
+
+    def __init__(self, logger, reconnect_min=1, reconnect_max=60):
+        self.logger = logger
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def call_later(self, delay, callback, *args):
+        return threadTimer(delay, callback, args)
+
+    def call_soon(self, callback, *args):
+        return threadTimer(0, callback, args)
+
+    def connect(self, client, host, port):
+        # paho doubles the delay itself and resets it on a successful connect, only the start is jittered
+        client.reconnect_delay_set(self.reconnect_min * random.uniform(1, 1.5), self.reconnect_max)
+        client.connect_async(host, port)
+        client.loop_start()
+
+    def reconnect(self, client, host, port):
+        client.disconnect()
+        client.loop_stop()
+        client.connect_async(host, port)
+        client.loop_start()
+
+    def disconnect(self, client):
+        client.disconnect()
+
+
+class asyncioRuntime(object):
+    # one asyncio event loop drives the sockets of all clients, timers and pacing
+    is_async = True
+
+    def __init__(self, logger, reconnect_min=1, reconnect_max=60):
+        self.logger = logger
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+        self._misc = {}
+        self._targets = {}
+        self._backoff = {}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.loop.run_forever, name="asyncio-runtime", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self._shutdown)
+        self._thread.join(timeout=5)
+        self._thread = None
+
+    def _shutdown(self):
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+        # runs after the cancelled tasks got their turn
+        self.loop.call_soon(self.loop.stop)
+
+    def in_loop(self):
+        return threading.current_thread() is self._thread
+
+    def _threadsafe(self, callback, *args):
+        if self.in_loop():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        handle = asyncioTimer(self)
+        self._threadsafe(handle.schedule, delay, callback, args)
+        return handle
+
+    def call_soon(self, callback, *args):
+        # FIFO with respect to other call_soon calls, from any thread
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def create_task(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def awaitable(self, future):
+        # request futures can be awaited from coroutines running on this loop
+        return asyncio.wrap_future(future, loop=self.loop)
+
+    def _attach(self, client):
+        client.on_socket_open = self._socket_open
+        client.on_socket_close = self._socket_close
+        client.on_socket_register_write = self._socket_register_write
+        client.on_socket_unregister_write = self._socket_unregister_write
+
+    def _socket_open(self, client, userdata, sock):
+        self._threadsafe(self._add_reader, client, sock)
+
+    def _add_reader(self, client, sock):
+        self.loop.add_reader(sock, self._read, client, sock)
+        self._misc[client] = self.loop.create_task(self._misc_loop(client))
+
+    def _read(self, client, sock):
+        # TLS can hold decrypted packets the selector never reports, drain them like paho's own loop does
+        while client.loop_read() == mqtt.MQTT_ERR_SUCCESS:
+            if client.socket() is not sock or not hasattr(sock, "pending") or sock.pending() <= 0:
+                break
+
+    def _socket_close(self, client, userdata, sock):
+        self._threadsafe(self._remove_socket, client, sock)
+
+    def _remove_socket(self, client, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        misc = self._misc.pop(client, None)
+        if misc is not None:
+            misc.cancel()
+        if client in self._targets:
+            self._retry(client)
+
+    def _socket_register_write(self, client, userdata, sock):
+        self._threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def _socket_unregister_write(self, client, userdata, sock):
+        self._threadsafe(self.loop.remove_writer, sock)
+
+    async def _misc_loop(self, client):
+        while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            if client.is_connected():
+                self._backoff[client].reset()
+            await asyncio.sleep(1)
+
+    def _retry(self, client):
+        delay = self._backoff[client].next()
+        host, port = self._targets[client]
+        self.logger.info("reconnecting to %s:%d in %.1fs", host, port, delay)
+        self.loop.call_later(delay, self._start_connect, client)
+
+    def _start_connect(self, client):
+        if client in self._targets:
+            self.loop.create_task(self._connect(client))
+
+    async def _connect(self, client):
+        # the blocking TCP/TLS handshake runs in the default executor
+        host, port = self._targets[client]
+        try:
+            await self.loop.run_in_executor(None, client.connect, host, port)
+        except OSError as exc:
+            self.logger.warning("connect to %s:%d failed: %s", host, port, exc)
+            if client in self._targets:
+                self._retry(client)
+
+    def connect(self, client, host, port):
+        self.start()
+        self._attach(client)
+        self._targets[client] = (host, port)
+        self._backoff[client] = reconnectBackoff(self.reconnect_min, self.reconnect_max)
+        self._threadsafe(self._start_connect, client)
+
+    def reconnect(self, client, host, port):
+        self._targets[client] = (host, port)
+        self._backoff.setdefault(client, reconnectBackoff(self.reconnect_min, self.reconnect_max)).reset()
+        self._threadsafe(self._reconnect, client)
+
+    def _reconnect(self, client):
+        if client in self._misc:
+            # the socket close handler starts the connect to the new target
+            client.disconnect()
+        else:
+            self._start_connect(client)
+
+    def disconnect(self, client):
+        self._targets.pop(client, None)
+        self._threadsafe(client.disconnect)
+
+
+class asyncioTimer(object):
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self._handle = None
+        self._cancelled = False
+
+    def schedule(self, delay, callback, args):
+        if not self._cancelled:
+            self._handle = self.runtime.loop.call_later(delay, callback, *args)
+
+    def cancel(self):
+        self._cancelled = True
+        self.runtime._threadsafe(self._cancel)
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+
+
+def create_runtime(logger, name=None, reconnect_min=1, reconnect_max=60):
+    if name == "asyncio":
+        return asyncioRuntime(logger, reconnect_min, reconnect_max)
+    return threadRuntime(logger, reconnect_min, reconnect_max)
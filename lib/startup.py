@@ -0,0 +1,52 @@
+import threading
+import time
+
+
+STAGE_NHC_CONNECTED = "NHC connected"
+STAGE_REGISTRY_LOADED = "registry loaded"
+STAGE_HASS_CONNECTED = "HA connected"
+STAGE_DISCOVERY_COMPLETE = "discovery complete"
+
+STAGES = [STAGE_NHC_CONNECTED, STAGE_REGISTRY_LOADED, STAGE_HASS_CONNECTED, STAGE_DISCOVERY_COMPLETE]
+
+
+class startupPipeline(object):
+    def __init__(self, logger):
+        self.logger = logger
+        self.started = time.monotonic()
+        self.timings = {}
+        self._events = {}
+        self._listeners = {}
+        self._lock = threading.Lock()
+        for stage in STAGES:
+            self._events[stage] = threading.Event()
+            self._listeners[stage] = []
+
+    def on(self, stage, callback):
+        self._listeners[stage].append(callback)
+
+    def is_set(self, stage):
+        return self._events[stage].is_set()
+
+    def mark(self, stage):
+        with self._lock:
+            if self._events[stage].is_set():
+                return
+            self.timings[stage] = time.monotonic() - self.started
+            self._events[stage].set()
+        self.logger.info("startup: %s after %.2fs", stage, self.timings[stage])
+        if stage == STAGE_DISCOVERY_COMPLETE:
+            self.logger.info("startup: %s", ", ".join("%s %.2fs" % (s, self.timings[s]) for s in STAGES if s in self.timings))
+        for callback in self._listeners[stage]:
+            callback()
+
+    def wait(self, stages, timeout=None):
+        # wait until all stages are reached, False when the timeout expired first
+        if isinstance(stages, str):
+            stages = [stages]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for stage in stages:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not self._events[stage].wait(remaining):
+                return False
+        return True
@@ -0,0 +1,144 @@
+import threading
+from collections import deque
+
+
+POLICY_BLOCK = "block"
+POLICY_DROP_OLDEST = "drop-oldest"
+
+_BARRIER = object()
+
+
+class workQueue(object):
+    # bounded handoff between the NHC network thread and the Hass publishers;
+    # work for one device always lands on the same worker, so it stays ordered
+    def __init__(self, logger, runtime, maxsize=1000, policy=POLICY_BLOCK, workers=1, report_interval=60):
+        if policy not in [POLICY_BLOCK, POLICY_DROP_OLDEST]:
+            logger.warning("unknown queue policy '%s', using '%s'", policy, POLICY_BLOCK)
+            policy = POLICY_BLOCK
+        self.logger = logger
+        self.runtime = runtime
+        self.policy = policy
+        self.maxsize = max(1, maxsize // max(1, workers))
+        self.report_interval = report_interval
+        self.dropped = 0
+        self.high_water = 0
+        self.metrics = None
+        self._shards = [deque() for _ in range(max(1, workers))]
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        for index in range(len(self._shards)):
+            thread = threading.Thread(target=self._worker, args=(index,), name="hass-worker-%d" % index, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.report_interval:
+            self.runtime.call_later(self.report_interval, self._report)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._threads = []
+
+    def depth(self):
+        with self._cond:
+            return sum(len(shard) for shard in self._shards)
+
+    def stats(self):
+        return {"depth": self.depth(), "high_water": self.high_water, "dropped": self.dropped, "policy": self.policy}
+
+    def _key(self, args):
+        if args and isinstance(args[0], dict):
+            return args[0].get("Uuid")
+        if args:
+            return args[0]
+        return None
+
+    def handoff(self, callback, merge=False):
+        # wraps a callback so calling it queues the work instead of running it;
+        # merge marks status work (device, changes, ...) that drop-oldest may fold into newer work
+        def _handoff(*args):
+            self._put(self._key(args), callback, args, merge)
+        return _handoff
+
+    def put(self, key, callback, *args):
+        self._put(key, callback, args, False)
+
+    def _put(self, key, callback, args, merge):
+        shard = self._shards[hash(key) % len(self._shards)]
+        with self._cond:
+            if len(shard) >= self.maxsize:
+                if self.policy == POLICY_BLOCK:
+                    while len(shard) >= self.maxsize and self._running:
+                        self._cond.wait()
+                else:
+                    args = self._drop_oldest(shard, key, args, merge)
+            shard.append((key, callback, args, merge))
+            depth = sum(len(s) for s in self._shards)
+            if depth > self.high_water:
+                self.high_water = depth
+            self._cond.notify_all()
+
+    def barrier(self, callback, *args):
+        # callback runs once all work queued before it is done, on every worker
+        remaining = [len(self._shards)]
+        lock = threading.Lock()
+
+        def _arrive():
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                callback(*args)
+
+        with self._cond:
+            for shard in self._shards:
+                shard.append((_BARRIER, _arrive, (), False))
+            self._cond.notify_all()
+
+    def _drop_oldest(self, shard, key, args, merge):
+        # only a status superseded by newer status work of the same device is dropped, its changes folded in;
+        # other devices keep their queued state changes and the shard grows past its bound instead
+        last = None
+        if merge:
+            for item in shard:
+                if item[0] == key:
+                    last = item
+        if last is None or not last[3]:
+            return args
+        shard.remove(last)
+        self.dropped += 1
+        if self.metrics is not None:
+            self.metrics.inc("hass_queue_dropped_total")
+        self.logger.debug("queue full, merged status for %s", key)
+        changes = dict(last[2][1])
+        changes.update(args[1])
+        return (args[0], changes) + tuple(args[2:])
+
+    def _worker(self, index):
+        shard = self._shards[index]
+        while True:
+            with self._cond:
+                while not shard and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                key, callback, args, merge = shard.popleft()
+                self._cond.notify_all()
+            try:
+                callback(*args)
+            except Exception as exc:
+                self.logger.error("work for %s failed: %s", key, exc)
+
+    def _report(self):
+        if not self._running:
+            return
+        stats = self.stats()
+        if stats["depth"] or stats["dropped"]:
+            self.logger.info("hass queue depth:%d high-water:%d dropped:%d", stats["depth"], stats["high_water"], stats["dropped"])
+        self.runtime.call_later(self.report_interval, self._report)
@@ -0,0 +1,45 @@
+import threading
+
+
+class commandMailbox(object):
+    def __init__(self, logger, hobby, runtime, window=0.2):
+        self.logger = logger
+        self.hobby = hobby
+        self.runtime = runtime
+        self.window = window
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def submit(self, uuid, properties):
+        # keep only the latest value per property, send after the debounce window
+        if not self.window:
+            return self.hobby.devices_control_bulk({uuid: properties})
+        with self._lock:
+            self._pending.setdefault(uuid, {}).update(properties)
+            if self._timer is None:
+                self._timer = self.runtime.call_later(self.window, self.flush)
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return True
+        self.logger.debug("flushing commands for %d devices", len(pending))
+        return self.hobby.devices_control_bulk(pending)
+
+    def discard(self):
+        with self._lock:
+            self._pending = {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
@@ -1,13 +1,26 @@
 import os
+import json
 import logging
 import socket
 import struct
+import threading
 
 
 class discoverNHC(object):
-    def __init__(self, logger, host=None):
+    def __init__(self, logger, host=None, cache_file=None, port=8884, mac=None):
         self.logger = logger
         self.host = host
+        self.cache_file = cache_file
+        self.port = port
+        # with several gateways on the network the MAC picks ours out of the replies,
+        # given as the 4 bytes a CoCo announces, aa:bb:cc:dd
+        self.mac = mac
+        # nhc_host may be a name, the broadcast replies carry the IP it resolves to
+        self.address = None
+        self.gateway = None
+        self.on_change = None
+        self._watcher = None
+        self._watching = False
 
     def _decode_discover(self, data):
         frame = {}
@@ -26,33 +39,113 @@ class discoverNHC(object):
         self.logger.info("discovered a %s with IP=%s and SW=%s", frame["device"], frame["ip"], frame["sw"])
         return frame
 
-    def discover(self):
+    def _load_cache(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return None
         try:
-            socket.gethostbyname(self.host)
-            self.logger.info("using predefined gateway %s", self.host)
-            return self.host
-        except:
-            pass
+            with open(self.cache_file, mode='r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _save_cache(self, gateway):
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file, mode='w') as fp:
+                json.dump(gateway, fp)
+        except OSError as exc:
+            self.logger.warning("gateway cache %s not written: %s", self.cache_file, exc)
+
+    def _reachable(self, host, timeout=1.0):
+        try:
+            with socket.create_connection((host, self.port), timeout=timeout):
+                return True
+        except OSError:
+            return False
+
+    def _broadcast(self, timeout=2.0):
         message = b'D'
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(('', 10000))
-        s.settimeout(2.0)
+        s.settimeout(timeout)
         s.sendto(message,('<broadcast>', 10000))
-        self.gateway = None
+        gateway = None
         try:
             while True:
                 data = s.recv(30)
                 if len(data) > 14:
-                    self.gateway = self._decode_discover(data)
-                    if self.gateway["device"] == "CoCo":
+                    frame = self._decode_discover(data)
+                    if frame["device"] == "CoCo" and (self.mac is None or frame["nhcmac"] == self.mac.lower()):
+                        gateway = frame
                         break
         except socket.timeout:
             pass
         finally:
             s.close()
+        if gateway is not None:
+            self._save_cache(gateway)
+        return gateway
+
+    def _background_discover(self):
+        gateway = self._broadcast()
+        if gateway is None or gateway["ip"] == self.address:
+            return
+        self.logger.warning("gateway moved from %s to %s", self.host, gateway["ip"])
+        self.gateway = gateway
+        self.host = self.address = gateway["ip"]
+        if self.on_change is not None:
+            self.on_change(self.host)
+
+    def discover(self):
+        try:
+            self.address = socket.gethostbyname(self.host)
+            self.logger.info("using predefined gateway %s", self.host)
+            return self.host
+        except:
+            pass
+        cached = self._load_cache()
+        if cached is not None:
+            self.gateway = cached
+            self.host = self.address = cached["ip"]
+            if self._reachable(self.host):
+                self.logger.info("using last known gateway %s", self.host)
+            else:
+                # try the cached address anyway, a broadcast in the background corrects it
+                self.logger.info("last known gateway %s not reachable, discovering in background", self.host)
+                threading.Thread(target=self._background_discover, name="nhc-discover", daemon=True).start()
+            return self.host
+        self.gateway = self._broadcast()
         if self.gateway is None:
             self.logger.info("did not discover a gateway")
             return None
-        self.host = self.gateway["ip"]
+        self.host = self.address = self.gateway["ip"]
         return self.host
+
+    def start_watch(self, on_change, interval=60):
+        # rediscover periodically and report when the gateway got another IP
+        self.on_change = on_change
+        if self._watcher is not None:
+            return
+        self._watching = True
+        self._watch_event = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="nhc-watch", daemon=True)
+        self._watcher.start()
+
+    def stop_watch(self):
+        if self._watcher is None:
+            return
+        self._watching = False
+        self._watch_event.set()
+        self._watcher = None
+
+    def _watch(self, interval):
+        while not self._watch_event.wait(interval):
+            if not self._watching:
+                return
+            try:
+                self._background_discover()
+            except OSError as exc:
+                self.logger.warning("gateway watch failed: %s", exc)
@@ -1,15 +1,20 @@
 import os
 import paho.mqtt.client as mqtt
 from nhc.discover import discoverNHC
-import threading
+from nhc.registry import deviceRegistry, normalize_properties, DEVICE_ROW_FIELDS
+from nhc.request import requestTracker
+from nhc.commands import commandMailbox
+from nhc.snapshot import deviceSnapshot
+from lib.startup import startupPipeline, STAGE_NHC_CONNECTED, STAGE_REGISTRY_LOADED
+from lib.runtime import create_runtime
+from lib.metrics import metricsRegistry
+from lib.recorder import trafficRecorder, SOURCE_NHC
 import json
-import logging
-import struct
+import csv
+import io
 from prettytable import PrettyTable
 from uuid import UUID
 import yaml
-import time
-import datetime
 
 
 TOPIC_DEVICES_CMD = "hobby/control/devices/cmd"
@@ -32,6 +37,10 @@ TOPIC_NOTIFICATION_RSP = "hobby/notification/rsp"
 TOPIC_NOTIFICATION_ERR = "hobby/notification/err"
 TOPIC_NOTIFICATION_EVT = "hobby/notification/evt"
 
+# settings of the first gateway that another gateway never inherits
+GATEWAY_PRIVATE_CONFIG = ["gateways", "name", "nhc_host", "nhc_mac", "nhc_port", "nhc_gateway_cache", "nhc_client_id",
+                          "nhc_snapshot_file", "record_file", "metrics_port"]
+
 class NHC_MODELS():
     ALL = 0
     RELAY = 1
@@ -65,19 +74,33 @@ class controlNHC(object):
         self.hobby.devices_control(
             device, "Action", action, "Position", str(position))
 
+    def bulk(self, devices, properties):
+        _list = []
+        for device in devices:
+            if self.hobby.search_uuid_action(device, NHC_MODELS.ALL) is not None:
+                _list.append((device, properties))
+        if not _list:
+            return
+        self.hobby.devices_control_bulk(_list)
+
 
 class hobbyAPI(object):
-    def __init__(self, logger, configfile=None):
+    def __init__(self, logger, configfile=None, pipeline=None, parent=None, gateway=None):
+        # parent is the first gateway, an extra gateway shares its runtime and metrics
         self.logger = logger
         self.configfile = configfile
-        self.discover = discoverNHC(self.logger)
-        self.host = self.discover.discover()
+        self.parent = parent
+        self.pipeline = pipeline
+        if self.pipeline is None:
+            self.pipeline = startupPipeline(self.logger)
         self.port = 8884
         self.connect_timeout = 60
         self.connected = False
         self.client = None
         self.systeminfo = None
-        self.devices = None
+        self.devices = deviceRegistry()
+        self._gateway_info = None
+        self._gateway_uuids = set()
         self.locations = None
         self.device_update_callback = None
         self.device_remove_callback = None
@@ -87,7 +110,55 @@ class hobbyAPI(object):
         self.dimmer_models = ["dimmer"]
         self.motor_models = ["rolldownshutter", "sunblind", "gate", "venetianblind"]
         self.mood_models = ["comfort", "alloff", "generic"]
+        self.config = None
+        self.disable_marker = None
         self.read_config()
+        self.name = None
+        if parent is None:
+            self.gateways = [self]
+            self.metrics = metricsRegistry(self.logger)
+            self._describe_metrics()
+            self.runtime = create_runtime(self.logger, self.get_config("runtime"),
+                                          reconnect_min=self.get_config("mqtt_reconnect_min", 1),
+                                          reconnect_max=self.get_config("mqtt_reconnect_max", 60))
+            self.runtime.start()
+        else:
+            self._gateway_config(gateway)
+            self.name = self.get_config("name", "gateway%d" % (len(parent.gateways) + 1))
+            self.gateways = parent.gateways
+            self.gateways.append(self)
+            self.metrics = parent.metrics
+            self.runtime = parent.runtime
+        self.port = self.get_config("nhc_port", 8884)
+        self.qos = self.get_config("nhc_qos", 1)
+        self.discover = discoverNHC(self.logger, self.get_config("nhc_host"), self.get_config("nhc_gateway_cache"), self.port,
+                                    self.get_config("nhc_mac"))
+        self.discover.on_change = self._gateway_moved
+        self.host = self.discover.discover()
+        self.requests = requestTracker(self.logger, self.runtime, self.get_config("nhc_request_timeout", 5))
+        self.commands = commandMailbox(self.logger, self, self.runtime, self.get_config("nhc_command_debounce", 0.2))
+        self.max_frame_size = self.get_config("nhc_max_frame_size", 16384)
+        self.snapshot = deviceSnapshot(self.logger, self.runtime, self.get_config("nhc_snapshot_file"),
+                                       self.get_config("nhc_snapshot_delay", 5))
+        self.snapshot.source = self._snapshot_frame
+        self.recorder = None
+        if self.get_config("record_file"):
+            self.recorder = trafficRecorder(self.logger, self.runtime, self.get_config("record_file"))
+        self._load_snapshot()
+        self._topic_handlers = {
+            TOPIC_DEVICES_RSP: self._message_devices_response,
+            TOPIC_DEVICES_ERR: self._message_devices_error,
+            TOPIC_DEVICES_EVT: self._message_devices_event,
+            TOPIC_LOCATIONS_RSP: self._message_locations_response,
+            TOPIC_LOCATION_ERR: self._message_location_error,
+            TOPIC_SYSTEM_EVT: self._message_system_event,
+            TOPIC_SYSTEM_RSP: self._message_system_response,
+            TOPIC_SYSTEM_ERR: self._message_system_error,
+            TOPIC_SYSTEM_TIME_RSP: self._message_system_time_response,
+            TOPIC_NOTIFICATION_RSP: self._message_notification_response,
+            TOPIC_NOTIFICATION_ERR: self._message_notification_error,
+            TOPIC_NOTIFICATION_EVT: self._message_notification_event,
+        }
 
 
     def read_config(self):
@@ -108,6 +179,57 @@ class hobbyAPI(object):
             except:
                 self.disable_marker = None
 
+    def _gateway_config(self, gateway):
+        config = dict((key, value) for key, value in (self.config or {}).items() if key not in GATEWAY_PRIVATE_CONFIG)
+        config.update(gateway)
+        self.config = config
+        self.disable_marker = self.get_config("hass_disable_marker")
+
+    def object_id(self, uuid):
+        # HA sees the devices of an extra gateway under its name, NHC uuids are only unique per gateway
+        if self.name is None:
+            return uuid
+        return self.name + "_" + uuid
+
+    def uuid_of(self, object_id):
+        if self.name is None:
+            return object_id
+        prefix = self.name + "_"
+        if not object_id.startswith(prefix):
+            return None
+        return object_id[len(prefix):]
+
+    def get_config(self, key, default=None):
+        try:
+            return self.config[key]
+        except:
+            return default
+
+    def _describe_metrics(self):
+        self.metrics.counter("nhc_messages_total", "MQTT messages received from the NHC gateway per topic")
+        self.metrics.counter("nhc_device_events_total", "NHC device events per devices.* method")
+        self.metrics.counter("mqtt_reconnects_total", "Reconnects per broker")
+        self.metrics.histogram("hass_set_to_nhc_seconds", "Latency from an HA set command to the NHC devices.control publish")
+        self.metrics.gauge("nhc_registry_devices", "Devices in the NHC registry",
+                           lambda: sum(len(gateway.devices) for gateway in self.gateways))
+        self.metrics.gauge("nhc_requests_in_flight", "NHC requests waiting for a response",
+                           lambda: sum(gateway.requests.in_flight() for gateway in self.gateways))
+        self.metrics.gauge("nhc_commands_pending", "Devices with debounced commands not yet sent",
+                           lambda: sum(gateway.commands.pending() for gateway in self.gateways))
+
+    def _snapshot_frame(self):
+        return {"devices": self.devices.snapshot(), "locations": self.locations, "systeminfo": self.systeminfo}
+
+    def _load_snapshot(self):
+        frame = self.snapshot.load()
+        if frame is None:
+            return
+        self.devices.load(frame.get("devices", []))
+        for device in self.devices:
+            self._hass_disable_marker(device)
+        self.locations = frame.get("locations")
+        self.systeminfo = frame.get("systeminfo")
+
     def set_callbacks(self, device_update_callback, device_remove_callback, device_add_callback):
         self.device_update_callback = device_update_callback
         self.device_remove_callback = device_remove_callback
@@ -116,97 +238,108 @@ class hobbyAPI(object):
     def _connect_timeout_handler(self):
         if self.connected:
             return
-        self.logger.info("Cannot connect to NHC broker")
-        self.connected = False
-        self.client.disconnect()
+        # the runtime keeps retrying with backoff, the registry stays as it is
+        self.logger.warning("Cannot connect to NHC broker within %ds, still trying", self.connect_timeout)
 
     def is_connected(self):
         return self.connected
 
-    def start(self):
+    def _create_client(self):
         try:
             self.password = self.config["password"]
         except:
             self.logger.error("no password in config")
-            return
+            return None
         try:
             self.username = self.config["username"]
         except:
             self.logger.error("no username in config")
-            return
+            return None
+        # with a fixed client id the broker keeps the subscriptions and queued QoS 1 events over a reconnect
+        client_id = self.get_config("nhc_client_id") or ""
+        client = mqtt.Client(client_id=client_id, clean_session=not client_id)
+        client.username_pw_set(self.username, self.password)
+        if not self.get_config("nhc_tls", True):
+            # plain MQTT, only meant for a simulated gateway on a local broker
+            return client
         try:
             self.ca_cert_file = self.config["ca_cert_hobby"]
         except:
             self.logger.error("no ca_cert in config")
-            return
-        if self.host is None:
-            self.logger.error("no COCO found")
-            return
+            return None
         if not os.path.exists(self.ca_cert_file):
             self.logger.error("Cannot find ca_cert file")
-            return
+            return None
+        client.tls_set(ca_certs=self.ca_cert_file)
+        client.tls_insecure_set(True)
+        return client
 
-        self.client = mqtt.Client()
-        self.client.username_pw_set(self.username, self.password)
-        self.client.tls_set(ca_certs=self.ca_cert_file)
-        self.client.tls_insecure_set(True)
+    def start(self, client=None):
+        if self.host is None:
+            self.logger.error("no COCO found")
+            return False
+        if client is None:
+            client = self._create_client()
+            if client is None:
+                return False
+
+        self.client = client
         self.client.on_message = self._message
         self.client.on_connect = self._connect
         self.client.on_disconnect = self.disconnect
-        self.client.connect_async(self.host, self.port)
-        self.connect_timer = threading.Timer(self.connect_timeout, self._connect_timeout_handler)
-        self.connect_timer.start()
-        self.client.loop_start()
+        if self.recorder is not None:
+            self.recorder.open()
+        self.connect_timer = self.runtime.call_later(self.connect_timeout, self._connect_timeout_handler)
+        self.runtime.connect(self.client, self.host, self.port)
+        watch_interval = self.get_config("nhc_gateway_watch", 0)
+        if watch_interval:
+            self.discover.start_watch(self._gateway_moved, watch_interval)
+        metrics_port = self.get_config("metrics_port")
+        if metrics_port:
+            self.metrics.start_http(metrics_port, self.get_config("metrics_host", "127.0.0.1"))
+        return True
+
+    def _gateway_moved(self, host):
+        # reconnect to the new address, the registry and hass entities are kept
+        self.logger.warning("reconnecting to gateway at %s", host)
+        self.host = host
+        self._invalidate_gateway_info()
+        if self.client is None:
+            return
+        self.runtime.reconnect(self.client, self.host, self.port)
 
     def stop(self):
+        self.discover.stop_watch()
+        if self.parent is None:
+            self.metrics.stop_http()
+        self.commands.flush()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.snapshot.flush()
         self.connected = False
-        self.client.disconnect()
+        if self.client is not None:
+            self.runtime.disconnect(self.client)
 
     def _message(self, client, obj, msg):
         #self.logger.info("Hobby mqtt message topic:%s\n%s", msg.topic, json.loads(msg.payload))
-        if msg.topic == TOPIC_DEVICES_RSP:
-            self._message_devices_response(client, msg)
-        elif msg.topic == TOPIC_DEVICES_ERR:
-            self._message_devices_error(client, msg)
-        elif msg.topic == TOPIC_DEVICES_EVT:
-            self._message_devices_event(client, msg)
-        elif msg.topic == TOPIC_LOCATIONS_RSP:
-            self._message_locations_response(client, msg)
-        elif msg.topic == TOPIC_LOCATION_ERR:
-            self._message_location_error(client, msg)
-        elif msg.topic == TOPIC_SYSTEM_EVT:
-            self._message_system_event(client, msg)
-        elif msg.topic == TOPIC_SYSTEM_RSP:
-            self._message_system_response(client, msg)
-        elif msg.topic == TOPIC_SYSTEM_TIME_RSP:
-            self._message_system_time_response(client, msg)
-        elif msg.topic == TOPIC_NOTIFICATION_RSP:
-            self._message_notification_event(client, msg)
-        elif msg.topic == TOPIC_NOTIFICATION_ERR:
-            self._message_notification_error(client, msg)
-        elif msg.topic == TOPIC_NOTIFICATION_EVT:
-            self._message_notification_event(client, msg)
-        else:
+        if self.recorder is not None:
+            self.recorder.record(SOURCE_NHC, msg.topic, msg.payload)
+        self.metrics.inc("nhc_messages_total", {"topic": msg.topic})
+        handler = self._topic_handlers.get(msg.topic)
+        if handler is None:
             self.logger.info("Hobby mqtt message '%s' on topic: %s", msg.payload, msg.topic)
-        if msg.topic.endswith("/rsp"):
-            self.cmd_busy = False
+            return
+        handler(client, msg)
 
     def _connect(self, client, obj, flags, rc):
         self.connected = True
         self.connect_timer.cancel()
         self.logger.info("Connected to HobbyAPI. rc:%d", rc)
-        self.client.subscribe(TOPIC_DEVICES_RSP, 0)
-        self.client.subscribe(TOPIC_DEVICES_ERR, 0)
-        self.client.subscribe(TOPIC_DEVICES_EVT, 0)
-        self.client.subscribe(TOPIC_LOCATIONS_RSP, 0)
-        self.client.subscribe(TOPIC_LOCATION_ERR, 0)
-        self.client.subscribe(TOPIC_SYSTEM_EVT, 0)
-        self.client.subscribe(TOPIC_SYSTEM_RSP, 0)
-        self.client.subscribe(TOPIC_SYSTEM_ERR, 0)
-        self.client.subscribe(TOPIC_SYSTEM_TIME_RSP, 0)
-        self.client.subscribe(TOPIC_NOTIFICATION_RSP, 0)
-        self.client.subscribe(TOPIC_NOTIFICATION_ERR, 0)
-        self.client.subscribe(TOPIC_NOTIFICATION_EVT, 0)
+        if self.pipeline.is_set(STAGE_NHC_CONNECTED):
+            self.metrics.inc("mqtt_reconnects_total", {"broker": "nhc"})
+        self.pipeline.mark(STAGE_NHC_CONNECTED)
+        self.client.subscribe([(topic, self.qos) for topic in self._topic_handlers])
+        # the sync requests are in flight together, none of them blocks the network thread
         self.systeminfo_get()
         self.devices_list_get()
         self.locations_list_get()
@@ -216,73 +349,148 @@ class hobbyAPI(object):
         self.logger.warning("Disconnected from HobbyAPI")
         self.connected = False
         self.connect_timer.cancel()
+        self.requests.cancel_all()
 
 
-    def wait_on_command(self):
-        self.cmd_busy = True
-        starttime = datetime.datetime.now()
-        while datetime.datetime.now().timestamp() < starttime.timestamp() + 5:
-            if self.cmd_busy is False:
-                elapsed = datetime.datetime.now() - starttime
-                msec = elapsed.seconds*1000 + round(elapsed.microseconds/1000)
-                self.logger.info("MQTT cmd-rsp time: " + str(msec) + "ms")
-                return True
-            time.sleep(0.1)
-        return False        
+    def _request(self, topic, frame, timeout=None):
+        # returns a Future resolved with the response frame of this request
+        method = frame["Method"]
+        if not self.connected:
+            return self.requests.failed(method, "not connected")
+        future = self.requests.register(topic, method, timeout)
+        self.client.publish(topic, json.dumps(frame))
+        return future
 
 
-    def devices_list_get(self):
-        if not self.connected:
-            return False
+    def devices_list_get(self, timeout=None):
         frame = {"Method": "devices.list"}
-        self.client.publish(TOPIC_DEVICES_CMD, json.dumps(frame))
-        return self.wait_on_command()
+        return self._request(TOPIC_DEVICES_CMD, frame, timeout)
 
 
     def get_device(self, uuid):
-        i = 0
-        while i < len(self.devices):
-            if self.devices[i]["Uuid"] == uuid:
-                return self.devices[i]
-            i += 1
-        return None
+        return self.devices.get(uuid)
 
     def devices_control(self, uuid, property1, value1, property2=None, value2=None):
-        if not self.connected:
-            return False
+        properties = {property1: value1}
+        if property2 is not None and value2 is not None:
+            properties[property2] = value2
+        return self.devices_control_bulk({uuid: properties})
+
+    def _publish_devices_control(self, frame_devices):
         frame = {}
         frame["Method"] = "devices.control"
-        frame_device = {}
-        frame_property1 = {property1: value1}
-        if property2 is not None and value2 is not None:
-            frame_property2 = {property2: value2}
-            frame_device["Properties"] = [frame_property1, frame_property2]
-        else:
-            frame_device["Properties"] = [frame_property1]
-        frame_device["Uuid"] = uuid
-        frame_devices = {}
-        frame_devices["Devices"] = [frame_device]
-        frame["Params"] = [frame_devices]
+        frame["Params"] = [{"Devices": frame_devices}]
         self.client.publish(TOPIC_DEVICES_CMD, json.dumps(frame))
+        for frame_device in frame_devices:
+            self.metrics.observe_since("hass_set_to_nhc_seconds", "hass_set", frame_device["Uuid"])
 
-    def _hass_disable_marker(self, index):
-        if self.disable_marker is None:
-            return
-        name = self.devices[index]["Name"]
-        self.devices[index]["HassEnabled"] = True
-        if name.endswith(self.disable_marker):
-            self.devices[index]["HassEnabled"] = False
+    def devices_control_bulk(self, devices, max_frame_size=None):
+        # devices: {uuid: {property: value}} or a list of (uuid, {property: value}) pairs,
+        # sent as few devices.control frames as max_frame_size allows
+        if not self.connected:
+            return False
+        if max_frame_size is None:
+            max_frame_size = self.max_frame_size
+        if isinstance(devices, dict):
+            devices = devices.items()
+        overhead = len(json.dumps({"Method": "devices.control", "Params": [{"Devices": []}]}))
+        chunk = []
+        size = overhead
+        frames = 0
+        for uuid, properties in devices:
+            frame_device = {}
+            frame_device["Properties"] = [{key: value} for key, value in properties.items()]
+            frame_device["Uuid"] = uuid
+            device_size = len(json.dumps(frame_device)) + 2
+            if chunk and size + device_size > max_frame_size:
+                self._publish_devices_control(chunk)
+                frames += 1
+                chunk = []
+                size = overhead
+            chunk.append(frame_device)
+            size += device_size
+        if chunk:
+            self._publish_devices_control(chunk)
+            frames += 1
+        self.logger.debug("devices.control sent in %d frame(s)", frames)
+        return True
+
+    def _hass_disable_marker(self, device):
+        with self.devices.lock:
+            device["HassEnabled"] = True
+            if self.disable_marker is None:
+                return
+            if device["Name"].endswith(self.disable_marker):
+                device["HassEnabled"] = False
 
     def _message_devices_response(self, client, msg):
         frame = json.loads(msg.payload)
-        self.devices = frame["Params"][0]["Devices"]
-        self.logger.info("initial devices list created")
-        i = 0
+        if frame["Method"] == "devices.list":
+            if self.pipeline.is_set(STAGE_REGISTRY_LOADED):
+                # a reconnect, pass on only what changed while we were away
+                self._resync_devices(frame["Params"][0]["Devices"])
+            else:
+                self._reconcile_devices(frame["Params"][0]["Devices"])
+                self.logger.info("initial devices list created")
+                self.status_add_all()
+            self.snapshot.mark_dirty()
+            self.pipeline.mark(STAGE_REGISTRY_LOADED)
+        self.requests.resolve(TOPIC_DEVICES_CMD, frame)
+
+    def _reconcile_devices(self, devices_in):
+        # devices known from the snapshot but gone from the live list are removed
+        live = set(device["Uuid"] for device in devices_in)
+        for device in self.devices:
+            if device["Uuid"] in live:
+                continue
+            self.logger.info("device '%s' (%s/%s) no longer present", device["Name"], device["Model"], device["Type"])
+            if self.device_remove_callback is not None:
+                self.device_remove_callback(device["Uuid"], device["Model"])
+        self.devices.load(devices_in)
+        self._invalidate_gateway_info()
         # search for additional configuration in the Name property
-        while i < len(self.devices):
-            self._hass_disable_marker(i)
-            i += 1
-        self.status_add_all()
+        for device in self.devices:
+            self._hass_disable_marker(device)
+
+    def _definition(self, device):
+        # everything but the live state, a difference means the device must be rediscovered
+        return dict((key, value) for key, value in device.items() if key not in ("Properties", "Online", "HassEnabled"))
+
+    def _resync_devices(self, devices_in):
+        live = {}
+        for device in devices_in:
+            live[device["Uuid"]] = normalize_properties(device)
+        removed = added = updated = 0
+        for device in self.devices:
+            if device["Uuid"] in live:
+                continue
+            self.logger.info("device '%s' (%s/%s) no longer present", device["Name"], device["Model"], device["Type"])
+            self.devices.remove(device["Uuid"])
+            removed += 1
+            if self.device_remove_callback is not None:
+                self.device_remove_callback(device["Uuid"], device["Model"])
+        for uuid, device in live.items():
+            known = self.devices.get(uuid)
+            if known is None or self._definition(known) != self._definition(device):
+                self.devices.add(device)
+                self._hass_disable_marker(device)
+                added += 1
+                if self.device_add_callback is not None and self._is_hass_device(device):
+                    self.device_add_callback(device)
+                continue
+            online = device.get("Online")
+            changes = self.devices.update_properties(known, [device["Properties"]])
+            if online is not None and known.get("Online") != online:
+                known["Online"] = online
+                changes["Online"] = online
+            if not changes or known["HassEnabled"] is False:
+                continue
+            updated += 1
+            if self.device_update_callback is not None:
+                self.device_update_callback(known, changes)
+        if removed or added:
+            self._invalidate_gateway_info()
+        self.logger.info("devices resynced: %d new or changed, %d removed, %d states updated", added, removed, updated)
 
     def _message_devices_error(self, client, msg):
         frame = json.loads(msg.payload)
@@ -290,188 +498,167 @@ class hobbyAPI(object):
         code = frame["ErrCode"]
         _ = frame["Method"]
         self.logger.info("%s (code:%s)", message, code)
+        self.requests.reject(TOPIC_DEVICES_CMD, frame)
+
+
+    def hass_models(self):
+        return self.relay_models + self.dimmer_models + self.motor_models + self.mood_models
 
+    def _is_hass_device(self, device):
+        return device.get("Type") == "action" and device.get("Model") in self.hass_models()
+
+    def hass_devices(self):
+        return self.devices.select(self.hass_models(), "action")
 
     def status_add_all(self):
-        models = self.relay_models + self.dimmer_models + self.motor_models + self.mood_models
-        i = 0
-        while i < len(self.devices):
-            time.sleep(0.01)
-            _device = self.devices[i]
-            _model = _device["Model"]
-            _type = _device["Type"]
-            if _type == "action" and _model in models:
-                self.device_add_callback(_device)
-            i += 1
-
-
-    def _device_status_update(self, device_index, frame):
+        if self.device_add_callback is None:
+            return
+        for _device in self.hass_devices():
+            self.device_add_callback(_device)
+
+
+    def _device_status_update(self, device, frame):
         call_callback = True
-        name = self.devices[device_index]["Name"]
-        try:
-            self.devices[device_index]["Online"] = frame["Online"]
+        name = device["Name"]
+        online = None
+        if "Online" in frame:
             call_callback = False
-        except:
-            pass
-        if 'Properties' not in self.devices[device_index]:
-            self.devices[device_index]["Properties"] = frame["Properties"]
+            if device.get("Online") != frame["Online"]:
+                online = frame["Online"]
+            with self.devices.lock:
+                device["Online"] = frame["Online"]
+        changes = self.devices.update_properties(device, frame.get("Properties", []))
+        if online is not None:
+            # an availability change is passed on, the properties of such a frame are not
+            changes = {"Online": online}
+            call_callback = True
+        if not changes:
             return
-        i = 0
-        while i < len(frame["Properties"]):
-            _property_new = list(frame["Properties"][i].keys())[0]
-            _value_new = list(frame["Properties"][i].values())[0]
-            j = 0
-            while j < len(self.devices[device_index]["Properties"]):
-                _property_device = list(self.devices[device_index]["Properties"][j].keys())[0]
-                _value_device = list(self.devices[device_index]["Properties"][j].values())[0]
-                if _property_new == _property_device:
-                    self.devices[device_index]["Properties"][j][_property_device] = _value_new
-                j += 1
-            i += 1
-        
-        if self.devices[device_index]["HassEnabled"] is False:
+
+        if device["HassEnabled"] is False:
             return
 
-        self.logger.info("device '%s' status changed: %s", name, frame)
-        
+        self.logger.info("device '%s' status changed: %s", name, changes)
+
         if self.device_update_callback is not None and call_callback:
-            self.device_update_callback(self.devices[device_index])
+            self.device_update_callback(device, changes)
 
 
     def _message_devices_event(self, client, msg):
         frame = json.loads(msg.payload)
         method = frame["Method"]
         devices_in = frame["Params"][0]["Devices"]
+        self.metrics.inc("nhc_device_events_total", {"method": method})
+        if method == "devices.status":
+            for device_in in devices_in:
+                self.metrics.mark("nhc_event", device_in["Uuid"])
+        self.snapshot.mark_dirty()
+        for device_in in devices_in:
+            if device_in["Uuid"] in self._gateway_uuids or self._is_gateway_device(device_in):
+                self._invalidate_gateway_info()
+                break
         if method == "devices.added":
-            for dev_index in range(len(devices_in)):
-                i = 0
-                _new = True
-                _name = devices_in[dev_index]["Name"]
-                _model = devices_in[dev_index]["Model"]
-                _type = devices_in[dev_index]["Type"]
-                while i < len(self.devices):
-                    uuid = devices_in[dev_index]["Uuid"]
-                    if self.devices[i]["Uuid"] == uuid:
-                        # update existing entry
-                        self.devices[i] = devices_in[dev_index]
-                        self._hass_disable_marker(i)
-                        self.logger.info("device '%s' (%s/%s) updated", _name, _model, _type)
-                        _new = False
-                        break
-                    i += 1
-                if _new:
-                    self.devices.append(devices_in[dev_index])
-                    self._hass_disable_marker(dev_index)
-                    if self.device_add_callback is not None:
-                        self.device_add_callback(devices_in[dev_index])
-                    self.logger.info("device '%s' (%s/%s) added", _name, _model, _type)
+            for device_in in devices_in:
+                _name = device_in["Name"]
+                _model = device_in["Model"]
+                _type = device_in["Type"]
+                self._hass_disable_marker(device_in)
+                if self.devices.add(device_in) is not None:
+                    # update existing entry
+                    self.logger.info("device '%s' (%s/%s) updated", _name, _model, _type)
+                    continue
+                if self.device_add_callback is not None:
+                    self.device_add_callback(device_in)
+                self.logger.info("device '%s' (%s/%s) added", _name, _model, _type)
             return
         # handle the rest of the methods
-        found = False
         # incoming message can have multiple devices
-        for dev_index in range(len(devices_in)):
-            i = 0
-            # walk through the devices list in memory
-            while i < len(self.devices):
-                uuid = devices_in[dev_index]["Uuid"]
-                if self.devices[i]["Uuid"] == uuid:
-                    # we have a match
-                    found = True
-                    _name = self.devices[i]["Name"]
-                    _model = self.devices[i]["Model"]
-                    _type = self.devices[i]["Type"]
-                    if method == "devices.removed":
-                        self.logger.info("device '%s' (%s/%s) removed", _name, _model, _type)
-                        if self.device_remove_callback is not None:
-                            self.device_remove_callback(uuid, _model)
-                        del self.devices[i]
-                    elif method == "devices.displayname_changed":
-                        new_name = devices_in[dev_index]["DisplayName"]
-                        self.devices[i]["Name"] = new_name
-                        self._hass_disable_marker(i)
-                        self.logger.info("device '%s' (%s/%s) name changed to '%s'", _name,  _model, _type, new_name)
-                    elif method == "devices.changed":
-                        self.devices[i]["PropertyDefinitions"] = devices_in[dev_index]["PropertyDefinitions"]
-                        self.logger.info("device '%s' (%s/%s) property definitions changed", _name, _model, _type)
-                    elif method == "devices.param_changed":
-                        self.devices[i]["Parameters"] = devices_in[dev_index]["Parameters"]
-                        self.logger.info("device '%s' (%s/%s) parameters changed", _name, _model, _type)
-                    elif method == "devices.status":
-                        self._device_status_update(i, devices_in[dev_index])
-                    else:
-                        # normally we don't come here
-                        self.logger.info("unknown device method: %s", method)
-                    break                                                                         
-                i += 1
-        if not found:
-            self.logger.info("no device (uuid:%s) found for action '%s'", uuid, method)  
+        for device_in in devices_in:
+            uuid = device_in["Uuid"]
+            device = self.devices.get(uuid)
+            if device is None:
+                self.logger.info("no device (uuid:%s) found for action '%s'", uuid, method)
+                continue
+            _name = device["Name"]
+            _model = device["Model"]
+            _type = device["Type"]
+            if method == "devices.removed":
+                self.logger.info("device '%s' (%s/%s) removed", _name, _model, _type)
+                if self.device_remove_callback is not None:
+                    self.device_remove_callback(uuid, _model)
+                self.devices.remove(uuid)
+            elif method == "devices.displayname_changed":
+                new_name = device_in["DisplayName"]
+                self.devices.rename(uuid, new_name)
+                self._hass_disable_marker(device)
+                self.logger.info("device '%s' (%s/%s) name changed to '%s'", _name,  _model, _type, new_name)
+            elif method == "devices.changed":
+                with self.devices.lock:
+                    device["PropertyDefinitions"] = device_in["PropertyDefinitions"]
+                self.logger.info("device '%s' (%s/%s) property definitions changed", _name, _model, _type)
+            elif method == "devices.param_changed":
+                moved = self.devices.update_parameters(device, device_in["Parameters"])
+                self.logger.info("device '%s' (%s/%s) parameters changed", _name, _model, _type)
+                if moved and device["HassEnabled"] is not False and self._is_hass_device(device):
+                    # the location is part of the HA name and area, rediscover
+                    if self.device_add_callback is not None:
+                        self.device_add_callback(device)
+            elif method == "devices.status":
+                self._device_status_update(device, device_in)
+            else:
+                # normally we don't come here
+                self.logger.info("unknown device method: %s", method)
 
 
-    def print_devices(self, filtermodel=None, filtertype=None, fulltable=False, sortby="Name"):
-        if self.devices is None:
+    def print_devices(self, filtermodel=None, filtertype=None, fulltable=False, sortby="Name", filterlocation=None,
+                      limit=None, page=1, output="table"):
+        if not self.devices:
             self.logger.warn("no NHC devices found")
             return
 
+        fields = DEVICE_ROW_FIELDS if fulltable else DEVICE_ROW_FIELDS[:5]
+        _rows = self.devices.rows(filtermodel, filtertype, filterlocation)
+        column = DEVICE_ROW_FIELDS.index(sortby)
+        _rows.sort(key=lambda row: row[column])
+        total = len(_rows)
+        if limit is not None:
+            first = (max(page, 1) - 1) * limit
+            _rows = _rows[first:first + limit]
+        _rows = [row[:len(fields)] for row in _rows]
+
+        if output == "json":
+            return json.dumps([dict(zip(fields, row)) for row in _rows], indent=2)
+        if output == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(fields)
+            writer.writerows(_rows)
+            return buffer.getvalue().rstrip("\n")
         t = PrettyTable()
-        if fulltable:
-            t.field_names = ["Name", "Location", "Model", "Type", "UUID", "MAC", "Channel", "Online"]
-        else:
-            t.field_names = ["Name", "Location", "Model", "Type", "UUID"]
+        t.field_names = fields
         t.align = "l"
-        i = 0
-        while i < len(self.devices):
-            _device = self.devices[i]
-            _name = _device["Name"]
-            _model = _device["Model"]
-            _type = _device["Type"]
-            _uuid = _device["Uuid"]
-            _mac = ""
-            _channel = ""
-            _location = ""
-            try:
-                _online = _device["Online"]
-            except:
-                _online = "?"
-            j = 0
-            while j < len(_device["Parameters"]):
-                parameter = _device["Parameters"][j]
-                for key, value in parameter.items(): 
-                    if key == "LocationName":
-                        _location = value
-                    elif key == "LocationIcon":
-                        _location_icon = value
-                j += 1
-            j = 0
-            while j < len(_device["Traits"]):
-                trait = _device["Traits"][j]
-                for key, value in trait.items(): 
-                    if key == "MacAddress":
-                        _mac = value
-                    elif key == "Channel":
-                        _channel = value
-                j += 1
-
-            if filtermodel is None:
-                _print_model = True
-            elif _model in filtermodel:
-                _print_model = True
-            else:
-                _print_model = False
-
-            if filtertype is None:
-                _print_type = True
-            elif filtertype == _type:
-                _print_type = True
-            else:
-                _print_type = False
-
-            if _print_model and _print_type:
-                if fulltable:
-                    t.add_row([_name, _location, _model, _type, _uuid, _mac, _channel, _online])
-                else:
-                    t.add_row([_name, _location, _model, _type, _uuid])
-            i += 1
-        return str(t.get_string(sortby=sortby))
+        t.add_rows(_rows)
+        _table = str(t.get_string())
+        if limit is not None:
+            _table += "\npage %d: %d of %d devices" % (max(page, 1), len(_rows), total)
+        return _table
+
+    def print_locations(self):
+        # the locations of locations.list, plus any location only known from the devices
+        t = PrettyTable()
+        t.field_names = ["Location", "Icon", "Devices", "UUID"]
+        t.align = "l"
+        names = set()
+        for _location in self.locations or []:
+            _name = _location.get("Name")
+            names.add(_name)
+            t.add_row([_name, _location.get("Icon", ""), self.devices.location_count(_name), _location.get("Uuid", "")])
+        for _name in self.devices.location_names():
+            if _name in names:
+                continue
+            _devices = self.devices.by_location(_name)
+            t.add_row([_name, self.devices.location_icon(_devices[0]["Uuid"]) or "", len(_devices), ""])
+        return str(t.get_string(sortby="Location"))
 
     def print_mood_action(self):
         return self.print_devices(filtermodel=self.mood_models, filtertype="action")
@@ -490,50 +677,44 @@ class hobbyAPI(object):
             UUID(uuid)
         except ValueError:
             return None
-        _uuid = None
-        i = 0
-        while i < len(self.devices):
-            _device = self.devices[i]
-            _name = _device["Name"]
-            _model = _device["Model"]
-            _type = _device["Type"]
-            _uuid = _device["Uuid"]
-            if uuid == _uuid:
-                break
-            i += 1
-
-        if _uuid is None:
+        _device = self.devices.get(uuid)
+        if _device is None:
             self.logger.warning("uuid not found")
             return
 
         t = PrettyTable()
         t.field_names = ["Property", "Value"]
         t.align = "l"
-        i = 0
-        while i < len(_device["Properties"]):
-            _properties = _device["Properties"][i]
-            for key, value in _properties.items():
-                t.add_row([key, value])
-            i += 1
+        for key, value in _device["Properties"].items():
+            t.add_row([key, value])
         return str(t.get_string(sortby="Property"))
 
 
+    def _is_gateway_device(self, device):
+        if device.get("Model") == "nhc" and device.get("Type") == "home_automation":
+            return True
+        return device.get("Name") == "gatewayfw"
+
+    def _invalidate_gateway_info(self):
+        self._gateway_info = None
+
     def nhc_info(self):
-        frame = {"ip": self.discover.gateway["ip"]}
-        i = 0
-        while i < len(self.devices):
-            if self.devices[i]["Model"] == "nhc" and self.devices[i]["Type"] == "home_automation":
-                frame["gateway_name"] = self.devices[i]["Name"]
-            if self.devices[i]["Name"] == "gatewayfw":
-                frame["hubtype"] = self.devices[i]["Traits"][0]["HubType"]
-                j = 0
-                while j < len(self.devices[i]["Properties"]):
-                    _property = self.devices[i]["Properties"][j]
-                    for key, value in _property.items():
-                        if key == "CurrentFWInfo":
-                            frame["firmware"] = value
-                    j += 1
-            i += 1
+        # cached, shared by all discovery frames until a gateway device or systeminfo changes
+        if self._gateway_info is not None:
+            return self._gateway_info
+        frame = {"ip": self.host}
+        uuids = set()
+        for _device in self.devices.select("nhc", "home_automation"):
+            frame["gateway_name"] = _device["Name"]
+            uuids.add(_device["Uuid"])
+        for _device in self.devices:
+            if _device["Name"] == "gatewayfw":
+                frame["hubtype"] = _device["Traits"][0]["HubType"]
+                if "CurrentFWInfo" in _device["Properties"]:
+                    frame["firmware"] = _device["Properties"]["CurrentFWInfo"]
+                uuids.add(_device["Uuid"])
+        self._gateway_uuids = uuids
+        self._gateway_info = frame
         return frame
 
 
@@ -552,52 +733,41 @@ class hobbyAPI(object):
             models = self.motor_models
         else:
             models = self.relay_models + self.dimmer_models + self.motor_models + self.mood_models
-        i = 0
-        while i < len(self.devices):
-            _device = self.devices[i]
-            _name = _device["Name"]
-            _model = _device["Model"]
-            _type = _device["Type"]
-            _uuid = _device["Uuid"]
-            if _type == "action":
-                for model in models:
-                    if uuid == _uuid and model == _model:
-                        return _device
-            i += 1
+        _device = self.devices.get(uuid)
+        if _device is not None and _device["Type"] == "action" and _device["Model"] in models:
+            return _device
         self.logger.warning("uuid not found")
         return None
         
 
+    def search_actions(self, models=None, location=None):
+        # models may hold NHC models or the relay/dimmer/motor/mood groups
+        _models = []
+        for model in models or []:
+            if model in self.nhc_models:
+                _models += getattr(self, model + "_models")
+            else:
+                _models.append(model)
+        if not _models:
+            _models = self.relay_models + self.dimmer_models + self.motor_models + self.mood_models
+        return [_device["Uuid"] for _device in self.devices.select(_models, "action", location)]
+
     def list_uuid_action(self):
-        _list = []
         models = self.relay_models + self.dimmer_models + self.motor_models + self.mood_models
-        i = 0
-        while i < len(self.devices):
-            _device = self.devices[i]
-            _model = _device["Model"]
-            _type = _device["Type"]
-            _uuid = _device["Uuid"]
-            if _type == "action" and _model in models:
-                _list.append(_uuid)
-            i += 1
-        return _list
-
-
-    def locations_list_get(self):
-        if not self.connected:
-            return False
+        return [_device["Uuid"] for _device in self.devices.select(models, "action")]
+
+
+    def locations_list_get(self, timeout=None):
         frame = {"Method": "locations.list"}
-        self.client.publish(TOPIC_LOCATIONS_CMD, json.dumps(frame))
+        return self._request(TOPIC_LOCATIONS_CMD, frame, timeout)
 
-    def locations_listitems(self, uuid):
-        if not self.connected:
-            return False
+    def locations_listitems(self, uuid, timeout=None):
         frame = {}
-        frame["Method"] = "devices.listitems"
+        frame["Method"] = "locations.listitems"
         frame_uuid = {"Uuid":uuid}
         frame_locations = {"Locations": [frame_uuid]}
         frame["Params"] = [frame_locations]
-        self.client.publish(TOPIC_LOCATIONS_CMD, json.dumps(frame))
+        return self._request(TOPIC_LOCATIONS_CMD, frame, timeout)
 
     def _message_locations_response(self, client, msg):
         frame = json.loads(msg.payload)
@@ -605,8 +775,12 @@ class hobbyAPI(object):
         if method == "locations.list":
             self.locations = frame["Params"][0]["Locations"]
             self.logger.info("list of locations updated")
+            self.snapshot.mark_dirty()
+        elif method == "locations.listitems":
+            pass # the items are returned to the caller through the request future
         else:
             self.logger.info("unknown method: %s", method)
+        self.requests.resolve(TOPIC_LOCATIONS_CMD, frame)
 
     def _message_location_error(self, client, msg):
         frame = json.loads(msg.payload)
@@ -614,10 +788,13 @@ class hobbyAPI(object):
         code = frame["ErrCode"]
         method = frame["Method"]
         self.logger.info("%s (code:%s)", message, code)
+        self.requests.reject(TOPIC_LOCATIONS_CMD, frame)
 
     def _update_systeminfo(self, frame):
         self.systeminfo = frame
+        self._invalidate_gateway_info()
         self.logger.info("systeminfo updated")
+        self.snapshot.mark_dirty()
 
     def _message_system_event(self, client, msg):
         frame = json.loads(msg.payload)
@@ -636,22 +813,24 @@ class hobbyAPI(object):
     def _message_system_response(self, client, msg):
         frame = json.loads(msg.payload)
         self._update_systeminfo(frame["Params"][0]["SystemInfo"][0])
+        self.requests.resolve(TOPIC_SYSTEM_CMD, frame)
 
-    def systeminfo_get(self):
-        if not self.connected:
-            return False
+    def _message_system_error(self, client, msg):
+        frame = json.loads(msg.payload)
+        self.logger.info("%s (code:%s)", frame["ErrMessage"], frame["ErrCode"])
+        self.requests.reject(TOPIC_SYSTEM_CMD, frame)
+
+    def systeminfo_get(self, timeout=None):
         frame = {"Method": "systeminfo.publish"}
-        self.client.publish(TOPIC_SYSTEM_CMD, json.dumps(frame))
+        return self._request(TOPIC_SYSTEM_CMD, frame, timeout)
 
     def _message_system_time_response(self, client, msg):
         frame = json.loads(msg.payload)
         pass
 
-    def notifications_list_get(self):
-        if not self.connected:
-            return False
+    def notifications_list_get(self, timeout=None):
         frame = {"Method": "notifications.list"}
-        self.client.publish(TOPIC_NOTIFICATION_CMD, json.dumps(frame))
+        return self._request(TOPIC_NOTIFICATION_CMD, frame, timeout)
 
     def notifications_update(self, uuid, status="read"):
         if not self.connected:
@@ -667,9 +846,17 @@ class hobbyAPI(object):
     def _message_notification_error(self, client, msg):
         frame = json.loads(msg.payload)
         self.logger.info(frame)
+        self.requests.reject(TOPIC_NOTIFICATION_CMD, frame)
 
-    def _message_notification_event(self, client, msg):
+    def _message_notification_response(self, client, msg):
         frame = json.loads(msg.payload)
+        self._notifications(frame)
+        self.requests.resolve(TOPIC_NOTIFICATION_CMD, frame)
+
+    def _message_notification_event(self, client, msg):
+        self._notifications(json.loads(msg.payload))
+
+    def _notifications(self, frame):
         j = 0
         while j < len(frame["Params"]):
             parameter = frame["Params"][j]
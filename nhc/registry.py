@@ -0,0 +1,251 @@
+import copy
+import threading
+
+
+NHC_HASS_MODELS = {
+    "light": "light",
+    "dimmer": "light",
+    "rolldownshutter": "cover",
+    "sunblind": "cover",
+    "gate": "cover",
+    "venetianblind": "cover",
+    "switched-fan": "fan",
+    "socket": "switch",
+    "switched-generic": "switch",
+    "pir": "switch_mood",
+    "comfort": "switch_mood",
+    "overallcomfort": "switch_mood",
+    "alloff": "switch_mood",
+    "generic": "switch_mood",
+}
+
+NHC_UNSUPPORTED_MODELS = ["alarms", "simulation", "timeschedule", "condition"]
+
+DEVICE_ROW_FIELDS = ["Name", "Location", "Model", "Type", "UUID", "MAC", "Channel", "Online"]
+
+
+def nhc_to_hass_model(nhc_model):
+    return NHC_HASS_MODELS.get(nhc_model)
+
+
+def normalize_properties(device):
+    # NHC sends properties as a list of single-key dicts, store them as one mapping
+    properties = device.get("Properties")
+    if isinstance(properties, dict):
+        return device
+    store = {}
+    for _property in properties or []:
+        store.update(_property)
+    device["Properties"] = store
+    return device
+
+
+def device_location(device):
+    # NHC keeps the location among the Parameters, not always in the first entry
+    name = icon = None
+    for parameter in device.get("Parameters") or []:
+        if "LocationName" in parameter:
+            name = parameter["LocationName"]
+        if "LocationIcon" in parameter:
+            icon = parameter["LocationIcon"]
+    return name, icon
+
+
+def device_row(device, location):
+    # the Online column is filled in when the row is rendered, it changes with every availability event
+    mac = channel = ""
+    for trait in device.get("Traits") or []:
+        if "MacAddress" in trait:
+            mac = trait["MacAddress"]
+        if "Channel" in trait:
+            channel = trait["Channel"]
+    return [device.get("Name"), location or "", device.get("Model"), device.get("Type"), device["Uuid"], mac, channel]
+
+
+class deviceRegistry(object):
+    def __init__(self):
+        self._devices = {}
+        self._by_model = {}
+        self._by_type = {}
+        self._by_hass_model = {}
+        self._by_location = {}
+        self._locations = {}
+        self._unlocated = {}
+        self._rows = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __iter__(self):
+        return iter(list(self._devices.values()))
+
+    def __contains__(self, uuid):
+        return uuid in self._devices
+
+    def _index_add(self, index, key, device):
+        if key is None:
+            return
+        index.setdefault(key, {})[device["Uuid"]] = device
+
+    def _index_remove(self, index, key, uuid):
+        bucket = index.get(key)
+        if bucket is None:
+            return
+        bucket.pop(uuid, None)
+        if not bucket:
+            del index[key]
+
+    def _link(self, device):
+        self._index_add(self._by_model, device.get("Model"), device)
+        self._index_add(self._by_type, device.get("Type"), device)
+        self._index_add(self._by_hass_model, nhc_to_hass_model(device.get("Model")), device)
+        location = device_location(device)
+        self._locations[device["Uuid"]] = location
+        self._index_add(self._by_location, location[0], device)
+        if location[0] is None:
+            self._unlocated[device["Uuid"]] = device
+        self._rows[device["Uuid"]] = device_row(device, location[0])
+
+    def _unlink(self, device):
+        uuid = device["Uuid"]
+        self._index_remove(self._by_model, device.get("Model"), uuid)
+        self._index_remove(self._by_type, device.get("Type"), uuid)
+        self._index_remove(self._by_hass_model, nhc_to_hass_model(device.get("Model")), uuid)
+        # the Parameters may already be replaced, unlink the location that was indexed
+        location = self._locations.pop(uuid, (None, None))
+        self._index_remove(self._by_location, location[0], uuid)
+        self._unlocated.pop(uuid, None)
+        self._rows.pop(uuid, None)
+
+    def get(self, uuid):
+        return self._devices.get(uuid)
+
+    def add(self, device):
+        # returns the replaced entry, or None when the device is new
+        with self.lock:
+            normalize_properties(device)
+            previous = self._devices.get(device["Uuid"])
+            if previous is not None:
+                self._unlink(previous)
+            self._devices[device["Uuid"]] = device
+            self._link(device)
+            return previous
+
+    def remove(self, uuid):
+        with self.lock:
+            device = self._devices.pop(uuid, None)
+            if device is not None:
+                self._unlink(device)
+            return device
+
+    def rename(self, uuid, name):
+        with self.lock:
+            device = self._devices.get(uuid)
+            if device is None:
+                return None
+            device["Name"] = name
+            self._rows[uuid][0] = name
+            return device
+
+    def update_parameters(self, device, parameters):
+        # returns True when the device moved to another location
+        with self.lock:
+            previous = self.location(device["Uuid"])
+            self._unlink(device)
+            device["Parameters"] = parameters
+            self._link(device)
+            return self.location(device["Uuid"]) != previous
+
+    def update_properties(self, device, properties):
+        # apply a list of single-key property dicts, return only what changed
+        with self.lock:
+            store = device.setdefault("Properties", {})
+            changes = {}
+            for _property in properties:
+                for key, value in _property.items():
+                    if store.get(key) != value:
+                        store[key] = value
+                        changes[key] = value
+            return changes
+
+    def clear(self):
+        with self.lock:
+            self._devices = {}
+            self._by_model = {}
+            self._by_type = {}
+            self._by_hass_model = {}
+            self._by_location = {}
+            self._locations = {}
+            self._unlocated = {}
+            self._rows = {}
+
+    def load(self, devices):
+        with self.lock:
+            self.clear()
+            for device in devices:
+                self.add(device)
+
+    def snapshot(self):
+        # a private copy of every device, safe to serialize while the NHC thread updates them
+        with self.lock:
+            return copy.deepcopy(list(self._devices.values()))
+
+    def uuids(self):
+        return list(self._devices.keys())
+
+    def by_model(self, models):
+        if isinstance(models, str):
+            models = [models]
+        _list = []
+        for model in models:
+            _list.extend(self._by_model.get(model, {}).values())
+        return _list
+
+    def by_type(self, devtype):
+        return list(self._by_type.get(devtype, {}).values())
+
+    def by_hass_model(self, hass_model):
+        return list(self._by_hass_model.get(hass_model, {}).values())
+
+    def by_location(self, location):
+        return list(self._by_location.get(location, {}).values())
+
+    def unlocated(self):
+        return list(self._unlocated.values())
+
+    def location(self, uuid):
+        return self._locations.get(uuid, (None, None))[0]
+
+    def location_icon(self, uuid):
+        return self._locations.get(uuid, (None, None))[1]
+
+    def location_names(self):
+        return sorted(self._by_location.keys())
+
+    def location_count(self, location):
+        return len(self._by_location.get(location, {}))
+
+    def select(self, models=None, devtype=None, location=None):
+        if location is not None:
+            _list = self.by_location(location)
+            if models is not None:
+                if isinstance(models, str):
+                    models = [models]
+                _list = [device for device in _list if device.get("Model") in models]
+        elif models is None and devtype is None:
+            return list(self._devices.values())
+        elif models is None:
+            return self.by_type(devtype)
+        else:
+            _list = self.by_model(models)
+        if devtype is not None:
+            _list = [device for device in _list if device.get("Type") == devtype]
+        return _list
+
+    def rows(self, models=None, devtype=None, location=None):
+        # flat table rows of the selected devices, only Online is read from the device itself
+        _rows = []
+        for device in self.select(models, devtype, location):
+            _rows.append(self._rows[device["Uuid"]] + [device.get("Online", "?")])
+        return _rows
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+
+
+class requestTracker(object):
+    def __init__(self, logger, runtime, timeout=5):
+        self.logger = logger
+        self.runtime = runtime
+        self.timeout = timeout
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def register(self, topic, method, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        future = Future()
+        future.method = method
+        future.started = time.monotonic()
+        future.latency = None
+        key = (topic, method)
+        with self._lock:
+            self._pending.setdefault(key, deque()).append(future)
+        future.timer = self.runtime.call_later(timeout, self._expire, key, future, timeout)
+        return future
+
+    def failed(self, method, reason):
+        future = Future()
+        future.method = method
+        future.latency = None
+        future.set_exception(ConnectionError("%s: %s" % (method, reason)))
+        return future
+
+    def in_flight(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._pending.values())
+
+    def _pop(self, key):
+        with self._lock:
+            queue = self._pending.get(key)
+            if not queue:
+                return None
+            future = queue.popleft()
+            if not queue:
+                del self._pending[key]
+        future.timer.cancel()
+        return future
+
+    def _expire(self, key, future, timeout):
+        with self._lock:
+            queue = self._pending.get(key)
+            if queue is None or future not in queue:
+                return
+            queue.remove(future)
+            if not queue:
+                del self._pending[key]
+        self.logger.warning("no response on '%s' within %.1fs", future.method, timeout)
+        future.set_exception(TimeoutError(future.method))
+
+    def resolve(self, topic, frame):
+        # match the oldest request with the same topic and method
+        future = self._pop((topic, frame.get("Method")))
+        if future is None:
+            return False
+        future.latency = time.monotonic() - future.started
+        self.logger.info("MQTT cmd-rsp time: %dms (%s)", round(future.latency * 1000), future.method)
+        future.set_result(frame)
+        return True
+
+    def reject(self, topic, frame):
+        future = self._pop((topic, frame.get("Method")))
+        if future is None:
+            return False
+        future.latency = time.monotonic() - future.started
+        future.set_exception(RuntimeError("%s (code:%s)" % (frame.get("ErrMessage"), frame.get("ErrCode"))))
+        return True
+
+    def cancel_all(self, reason="disconnected"):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        for queue in pending.values():
+            for future in queue:
+                future.timer.cancel()
+                future.set_exception(ConnectionError("%s: %s" % (future.method, reason)))
@@ -0,0 +1,66 @@
+import os
+import json
+import tempfile
+import threading
+
+
+class deviceSnapshot(object):
+    def __init__(self, logger, runtime, path, delay=5):
+        self.logger = logger
+        self.runtime = runtime
+        self.path = path
+        self.delay = delay
+        self.source = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, mode='r') as fp:
+                frame = json.load(fp)
+        except (OSError, ValueError) as exc:
+            self.logger.warning("snapshot %s not readable: %s", self.path, exc)
+            return None
+        self.logger.info("snapshot loaded with %d devices", len(frame.get("devices", [])))
+        return frame
+
+    def mark_dirty(self):
+        # coalesce a burst of events into one write after the delay
+        if self.path is None:
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = self.runtime.call_later(self.delay, self.save)
+
+    def flush(self):
+        with self._lock:
+            if self._timer is None:
+                return
+            self._timer.cancel()
+        self.save()
+
+    def save(self):
+        with self._lock:
+            self._timer = None
+        if self.path is None or self.source is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp_path = None
+        try:
+            frame = self.source()
+            # write next to the target and rename, so a crash never leaves a partial snapshot
+            fd, tmp_path = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+            with os.fdopen(fd, mode='w') as fp:
+                json.dump(frame, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.path)
+            tmp_path = None
+        except (OSError, TypeError, ValueError) as exc:
+            self.logger.warning("snapshot %s not written: %s", self.path, exc)
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import logging
+import platform
+import time
+import yaml
+from argparse import ArgumentParser
+from bench.harness import benchHarness
+
+
+LOGLEVELS = {"d": logging.DEBUG, "i": logging.INFO, "w": logging.WARNING, "e": logging.ERROR}
+
+
+def main(options):
+    logging.basicConfig(level=LOGLEVELS[options.loglevel], format="%(asctime)s %(levelname)s %(message)s")
+    logger = logging.getLogger("nhcbench")
+    config = {}
+    if options.nhcconfig is not None:
+        with open(options.nhcconfig, mode='r') as fp:
+            config = yaml.load(fp, Loader=yaml.FullLoader) or {}
+    result = {
+        "bench": {
+            "devices": options.devices,
+            "broker": options.broker or "loopback",
+            "python": platform.python_version(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "config": config,
+        }
+    }
+    harness = benchHarness(logger, devices=options.devices, broker=options.broker, config=config, timeout=options.timeout)
+    try:
+        harness.setup()
+        result["startup"] = harness.startup
+        result["event_throughput"] = harness.event_throughput(options.events, options.batch)
+        result["discovery"] = harness.discovery(cold=True)
+        result["rediscovery"] = harness.discovery(cold=False)
+        result["end_to_end"] = harness.end_to_end(options.events, options.rate, options.batch)
+        result["set_to_nhc"] = harness.set_to_nhc(options.sets)
+    finally:
+        harness.teardown()
+    output = json.dumps(result, indent=2)
+    if options.output == "-":
+        print(output)
+    else:
+        with open(options.output, mode='w') as fp:
+            fp.write(output + "\n")
+        logger.warning("results written to %s", options.output)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="NHC Hass bridge benchmark with a simulated COCO")
+    parser.add_argument('-d', '--devices', help='Number of synthetic devices', type=int, default=500)
+    parser.add_argument('-e', '--events', help='devices.status events per storm', type=int, default=5000)
+    parser.add_argument('-r', '--rate', help='Storm frames per second, 0 is unpaced', type=float, default=0)
+    parser.add_argument('-b', '--batch', help='Devices per devices.status frame', type=int, default=1)
+    parser.add_argument('-s', '--sets', help='Home Assistant set commands', type=int, default=200)
+    parser.add_argument('-m', '--broker', help='Local broker host:port, default is the in-process loopback')
+    parser.add_argument('-n', '--nhcconfig', help='Bridge configuration overrides (yaml)')
+    parser.add_argument('-t', '--timeout', help='Timeout per phase in seconds', type=int, default=60)
+    parser.add_argument('-o', '--output', help='JSON result file, - for stdout', default="bench.json")
+    parser.add_argument('-l', '--loglevel', help='Loglevel: d(ebug), i(nfo), w(arning), e(rror)', choices=['d','i','w','e'], default="w")
+    sys.exit(main(parser.parse_args()))
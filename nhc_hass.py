@@ -13,6 +13,9 @@ from nhc.hobby_api import hobbyAPI, controlNHC
 from hass.mqtt import Hass
 from lib.bridge_prompt import prompt
 from lib.mylogger import mylogger
+from lib.startup import startupPipeline, STAGE_NHC_CONNECTED, STAGE_HASS_CONNECTED
+from lib.workqueue import workQueue
+from lib.runtime import reconnectBackoff
 import subprocess
 from subprocess import PIPE, run
 
@@ -24,54 +27,107 @@ class Application():
         self.logger = clilogger.get_logger()
         self.hobby = None
         self.hass = None
+        self.workqueue = None
         self.running = False
+        self.stopping = False
 
     def run(self, foreground=False):
-        while True:
+        # a bridge that could not start is rebuilt with a growing delay, a running one never is
+        backoff = reconnectBackoff(15, 300)
+        while not self.stopping:
             try:
                 self.logger.info("NHC Hass Bridge started")
-                self.hobby = hobbyAPI(self.logger, self.nhcconfig)
+                self.pipeline = startupPipeline(self.logger)
+                self.hobby = hobbyAPI(self.logger, self.nhcconfig, pipeline=self.pipeline)
+                gateways = self.hobby.get_config("gateways", [])
+                if not all(gateway.get("nhc_host") or gateway.get("nhc_mac") for gateway in gateways):
+                    # a broadcast is answered by any gateway on the network, an extra one has to be pinned down
+                    self.logger.fatal("every entry of gateways needs an nhc_host or an nhc_mac (aa:bb:cc:dd)")
+                    self.teardown()
+                    return 1
+                for gateway in gateways:
+                    hobbyAPI(self.logger, self.nhcconfig, parent=self.hobby, gateway=gateway)
                 self.nhccontrol = controlNHC(self.hobby)
-                self.hass = Hass(self.logger, hobby=self.hobby)
-                self.hobby.start()
-                self.hass.start()
-                self.hobby.set_callbacks(self.hass.nhc_status_update, self.hass.nhc_remove_device, self.hass.nhc_add_device)
-
-                # give some time to connect
-                time.sleep(3)
+                self.hass = Hass(self.logger, hobby=self.hobby, pipeline=self.pipeline)
+                # NHC events are handed to worker threads, a slow HA broker cannot stall the NHC client
+                self.workqueue = workQueue(self.logger, self.hobby.runtime,
+                                           maxsize=self.hobby.get_config("hass_queue_size", 1000),
+                                           policy=self.hobby.get_config("hass_queue_policy", "block"),
+                                           workers=self.hobby.get_config("hass_queue_workers", 1))
+                self.workqueue.metrics = self.hobby.metrics
+                self.hobby.metrics.counter("hass_queue_dropped_total", "NHC events dropped because the Hass work queue was full")
+                self.hobby.metrics.gauge("hass_queue_depth", "NHC events waiting in the Hass work queue", self.workqueue.depth)
+                self.workqueue.start()
+                self.hass.workqueue = self.workqueue
+                self.hobby.set_callbacks(self.workqueue.handoff(self.hass.nhc_status_update, merge=True),
+                                         self.workqueue.handoff(self.hass.nhc_remove_device),
+                                         self.workqueue.handoff(self.hass.nhc_add_device))
+                for gateway in self.hobby.gateways[1:]:
+                    status_update, remove_device, add_device = self.hass.gateway_callbacks(gateway)
+                    gateway.set_callbacks(self.workqueue.handoff(status_update, merge=True),
+                                          self.workqueue.handoff(remove_device),
+                                          self.workqueue.handoff(add_device))
+                started = [gateway.start() for gateway in self.hobby.gateways]
+                started.append(self.hass.start())
+                if False in started:
+                    raise RuntimeError("bridge not started")
+
+                # move on as soon as both brokers are connected
+                self.pipeline.wait([STAGE_NHC_CONNECTED, STAGE_HASS_CONNECTED], timeout=self.hobby.connect_timeout)
                 self.running = self.overall_status()
 
                 # start infinite while loop
                 if foreground:
-                    app = prompt(self.clilogger, self.nhccontrol, self.hass)
+                    app = prompt(self.clilogger, self.nhccontrol, self.hass, self.workqueue)
                     sys.exit(app.cmdloop())
                 else:
-                    while self.running:
-                        self.running = self.overall_status()
+                    # a lost broker is reconnected in place by the runtime, the bridge is never rebuilt for it
+                    while not self.stopping:
+                        self.running = self.overall_status(self.running)
                         time.sleep(1)
 
                 return 0
             except Exception as exc:
                 self.logger.info("%s", format_exc())
                 self.logger.fatal("%s", exc)
+                self.teardown()
                 if foreground:
                     return 1
-            time.sleep(15)
+            delay = backoff.next()
+            self.logger.warning("restarting the bridge in %ds", delay)
+            time.sleep(delay)
+        return 0
 
     def shutdown(self, signum, frame):
         self.logger.info("Shutting down with signal %s", signal.Signals(signum).name)
+        self.stopping = True
+        self.teardown()
+
+    def teardown(self):
         if self.hobby is not None:
-            self.hobby.stop()
+            for gateway in self.hobby.gateways:
+                gateway.stop()
         if self.hass is not None:
             self.hass.stop()
+        if self.workqueue is not None:
+            self.workqueue.stop()
+        if self.hobby is not None:
+            self.hobby.runtime.stop()
+        self.hobby = None
+        self.hass = None
+        self.workqueue = None
 
-    def overall_status(self):
-        status_hobby = self.hobby.is_connected()
+    def overall_status(self, previous=True):
+        # logs only when the status flips, not every second while a broker is away
+        status_hobby = all(gateway.is_connected() for gateway in self.hobby.gateways)
         status_hass = self.hass.is_connected()
         if status_hobby and status_hass:
+            if not previous:
+                self.logger.warning("Bridge connected")
             return True
         else:
-            self.logger.error("Fault status: hobby:%d, hass:%d", status_hobby, status_hass)
+            if previous:
+                self.logger.error("Fault status: hobby:%d, hass:%d", status_hobby, status_hass)
             return False
 
 
@@ -113,7 +169,7 @@ class CreateApp(object):
             self.pid_file.acquire()
         daemon = Application(self.options, self.clilogger)
         try:
-            daemon.run(foreground=True)
+            return daemon.run(foreground=True)
         except (SystemExit, KeyboardInterrupt):
             daemon.shutdown(2, None)
 
@@ -130,7 +186,7 @@ class CreateApp(object):
         with context:
             self.logger.info("Starting service with pid %d", self.pid_file.read_pid())
             try:
-                daemon.run(foreground=False)
+                return daemon.run(foreground=False)
             except SystemExit:
                 daemon.shutdown(2, None)
 
@@ -144,9 +200,9 @@ def main(options):
         print("Missing NHC configuration file in arguments")
         return    
     elif options.foreground:
-        app.start_foreground()
+        return app.start_foreground()
     else:
-        app.start_daemon()
+        return app.start_daemon()
 
 
 if __name__ == '__main__':
@@ -155,4 +211,4 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--nhcconfig', help='NHC configuration file', default="./nhc.yaml")
     parser.add_argument('-f', '--foreground', help='Run in foreground', default=False, action='store_true')
     parser.add_argument('-k', '--kill', help='Kill running daemon', default=False, action='store_true')
-    main(parser.parse_args())
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import logging
+import cProfile
+import yaml
+from argparse import ArgumentParser
+from bench.replay import replayRunner
+
+
+LOGLEVELS = {"d": logging.DEBUG, "i": logging.INFO, "w": logging.WARNING, "e": logging.ERROR}
+
+
+def main(options):
+    logging.basicConfig(level=LOGLEVELS[options.loglevel], format="%(asctime)s %(levelname)s %(message)s")
+    logger = logging.getLogger("nhcreplay")
+    config = {}
+    if options.nhcconfig is not None:
+        with open(options.nhcconfig, mode='r') as fp:
+            config = yaml.load(fp, Loader=yaml.FullLoader) or {}
+    runner = replayRunner(logger, options.recording, config=config, speed=options.speed, timeout=options.timeout)
+    profiler = None
+    try:
+        runner.setup()
+        if options.profile is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        result = runner.run()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options.profile)
+            result["profile"] = options.profile
+        if options.metrics:
+            sys.stderr.write(runner.hobby.metrics.render())
+    finally:
+        runner.teardown()
+    output = json.dumps(result, indent=2)
+    if options.output == "-":
+        print(output)
+    else:
+        with open(options.output, mode='w') as fp:
+            fp.write(output + "\n")
+        logger.warning("results written to %s", options.output)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Replay recorded NHC and HA MQTT traffic through the bridge, without brokers")
+    parser.add_argument('recording', help='Recording made with record_file in the bridge configuration')
+    parser.add_argument('-x', '--speed', help='Replay speed: 1 is real time, 10 is ten times faster, 0 is maximum', type=float, default=1)
+    parser.add_argument('-n', '--nhcconfig', help='Bridge configuration used for the replay (yaml)')
+    parser.add_argument('-p', '--profile', help='Write cProfile statistics of the replay to this file')
+    parser.add_argument('-m', '--metrics', help='Print the bridge metrics after the replay', action='store_true', default=False)
+    parser.add_argument('-t', '--timeout', help='Timeout in seconds for startup and draining', type=int, default=60)
+    parser.add_argument('-o', '--output', help='JSON result file, - for stdout', default="-")
+    parser.add_argument('-l', '--loglevel', help='Loglevel: d(ebug), i(nfo), w(arning), e(rror)', choices=['d','i','w','e'], default="w")
+    sys.exit(main(parser.parse_args()))